@@ -1,7 +1,10 @@
 import os
 import sys
 
-sys.path.remove(os.path.abspath(os.path.dirname(sys.argv[0])))
+try:
+    sys.path.remove(os.path.abspath(os.path.dirname(sys.argv[0])))
+except ValueError:  # not on sys.path, e.g. when launched with `python -m`
+    pass
 import hashlib
 import logging
 from typing import Union
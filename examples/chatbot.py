@@ -7,7 +7,10 @@ import logging
 import os
 import sys
 
-sys.path.remove(os.path.abspath(os.path.dirname(sys.argv[0])))
+try:
+    sys.path.remove(os.path.abspath(os.path.dirname(sys.argv[0])))
+except ValueError:  # not on sys.path, e.g. when launched with `python -m`
+    pass
 import warnings
 from dataclasses import dataclass, field
 from typing import Optional
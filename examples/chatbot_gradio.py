@@ -8,7 +8,10 @@ import os
 import sys
 from dataclasses import dataclass, field
 
-sys.path.remove(os.path.abspath(os.path.dirname(sys.argv[0])))
+try:
+    sys.path.remove(os.path.abspath(os.path.dirname(sys.argv[0])))
+except ValueError:  # not on sys.path, e.g. when launched with `python -m`
+    pass
 import warnings
 from typing import Optional
 
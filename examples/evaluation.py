@@ -17,7 +17,10 @@ import json
 import os
 import sys
 
-sys.path.remove(os.path.abspath(os.path.dirname(sys.argv[0])))
+try:
+    sys.path.remove(os.path.abspath(os.path.dirname(sys.argv[0])))
+except ValueError:  # not on sys.path, e.g. when launched with `python -m`
+    pass
 from transformers import HfArgumentParser
 
 from lmflow.args import AutoArguments, DatasetArguments, ModelArguments
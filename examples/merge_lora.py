@@ -7,17 +7,22 @@ Merge base model and lora model into a full model.
 import os
 import sys
 
-sys.path.remove(os.path.abspath(os.path.dirname(sys.argv[0])))
+try:
+    sys.path.remove(os.path.abspath(os.path.dirname(sys.argv[0])))
+except ValueError:  # not on sys.path, e.g. when launched with `python -m`
+    pass
 
 from dataclasses import dataclass, field
 from typing import Optional
 
+import torch
 from transformers import HfArgumentParser
 
 from lmflow.args import (
     ModelArguments,
 )
 from lmflow.models.auto_model import AutoModel
+from lmflow.utils.model import merge_lora_weights_streaming
 
 
 @dataclass
@@ -32,6 +37,15 @@ class MergeLoraArguments:
         default=None,
         metadata={"help": "output merged full model path"},
     )
+    streaming: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "merge the lora weights into the safetensors checkpoint shard by shard, without loading the "
+                "full model. Peak memory is about one checkpoint shard."
+            ),
+        },
+    )
     local_rank: Optional[int] = field(
         default=-1,
         metadata={
@@ -50,6 +64,15 @@ def main():
     if merge_lora_args.device == "gpu":
         raise NotImplementedError("Merging LoRA weight using GPU not supported yet. Please use cpu.")
 
+    if merge_lora_args.streaming:
+        merge_lora_weights_streaming(
+            model_name_or_path=model_args.model_name_or_path,
+            lora_model_path=model_args.lora_model_path,
+            output_model_path=merge_lora_args.output_model_path,
+            torch_dtype=None if model_args.torch_dtype in ["auto", None] else getattr(torch, model_args.torch_dtype),
+        )
+        return
+
     model_args.use_lora = True
     model = AutoModel.get_model(
         model_args,
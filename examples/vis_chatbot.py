@@ -13,7 +13,10 @@ import numpy as np
 import requests
 from PIL import Image
 
-sys.path.remove(os.path.abspath(os.path.dirname(sys.argv[0])))
+try:
+    sys.path.remove(os.path.abspath(os.path.dirname(sys.argv[0])))
+except ValueError:  # not on sys.path, e.g. when launched with `python -m`
+    pass
 import time
 import warnings
 from typing import Optional
@@ -4,6 +4,7 @@ model_name_or_path=gpt2
 lora_model_path=output_models/lora
 output_model_path=output_models/merge_lora
 device=cpu
+streaming=False
 
 while [[ $# -ge 1 ]]; do
   key="$1"
@@ -24,6 +25,10 @@ while [[ $# -ge 1 ]]; do
       device="$2"
       shift
       ;;
+    --streaming)
+      streaming="$2"
+      shift
+      ;;
     *)
       echo "error: unknown option \"${key}\"" 1>&2
       exit 1
@@ -38,6 +43,7 @@ if [ ${device} == "cpu" ]; then
         --lora_model_path ${lora_model_path} \
         --output_model_path ${output_model_path} \
         --device ${device} \
+        --streaming ${streaming}
 elif [ ${device} == "gpu" ]; then
     echo "Error: Merging LoRA weights using gpu not supported yet. Please use cpu."
 else
@@ -25,6 +25,7 @@ extra_require = {
     "gradio": ["gradio"],
     "flask": ["flask", "flask_cors"],
     "flash_attn": ["flash-attn>=2.0.2"],
+    "liger": ["liger-kernel>=0.3.0"],
     # rich is lazy-imported by trl's DPOTrainer; not declared in trl 0.11.x.
     "trl": ["trl>=0.11,<0.12", "rich"],
     "deepspeed": ["deepspeed>=0.14.4"],
@@ -12,17 +12,24 @@ extracted from the MODEL_CONFIG_CLASSES.
 """
 
 import logging
+import os
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Optional
 
+import torch
 from transformers import (
     MODEL_FOR_CAUSAL_LM_MAPPING,
     TrainingArguments,
 )
+from transformers.utils import is_torch_tf32_available
 from transformers.utils.versions import require_version
 
-from lmflow.utils.versioning import is_flash_attn_available
+from lmflow.utils.versioning import (
+    is_flash_attn_available,
+    is_liger_kernel_available,
+    is_package_version_at_least,
+)
 
 MODEL_CONFIG_CLASSES = list(MODEL_FOR_CAUSAL_LM_MAPPING.keys())
 MODEL_TYPES = tuple(conf.model_type for conf in MODEL_CONFIG_CLASSES)
@@ -265,6 +272,17 @@ class ModelArguments:
         default=False,
         metadata={"help": ("whether use flash attention layer to reduce GPU memory with higher time cost.")},
     )
+    attn_implementation: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "The attention implementation to use in the model. When not specified, `flash_attention_2` is "
+                "used if `--use_flash_attention` is set, otherwise the transformers default (`sdpa`) is used. "
+                "`flex_attention` requires torch>=2.5."
+            ),
+            "choices": [None, "eager", "sdpa", "flash_attention_2", "flex_attention"],
+        },
+    )
     truncate_to_model_max_length: bool = field(
         default=True, metadata={"help": ("whether truncate the dataset to model max length.")}
     )
@@ -339,6 +357,9 @@ class ModelArguments:
                 logger.warning("use_qlora is set to True, but use_lora is not set to True. Setting use_lora to True.")
                 self.use_lora = True
 
+        if self.attn_implementation == "flash_attention_2":
+            self.use_flash_attention = True
+
         if self.use_flash_attention:
             if not is_flash_attn_available():
                 self.use_flash_attention = False
@@ -347,12 +368,21 @@ class ModelArguments:
                     "flash attention. If you want to use flash attention, please install by "
                     "`pip install -e '.[flash_attn]'`."
                 )
-        else:
+        elif self.attn_implementation is None:
             logger.warning(
                 "Flash attention is not enabled. We recommend enabling flash attention by "
                 "`--use_flash_attention 1` for better performance."
             )
 
+        if self.use_flash_attention:
+            self.attn_implementation = "flash_attention_2"
+        elif self.attn_implementation == "flash_attention_2":
+            self.attn_implementation = None
+
+        if self.attn_implementation == "flex_attention" and not is_package_version_at_least("torch", "2.5.0"):
+            logger.warning("`flex_attention` requires torch>=2.5. Falling back to the transformers default.")
+            self.attn_implementation = None
+
         if self.lora_target_modules is not None:
             self.lora_target_modules: list[str] = split_args(self.lora_target_modules)
 
@@ -648,6 +678,62 @@ class FinetunerArguments(TrainingArguments):
     lisa_layers_attribute: str = field(
         default="model.model.layers", metadata={"help": "where the layer attribute stores, e.g. model.model.layers"}
     )
+    dataloader_num_workers: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Number of subprocesses to use for data loading, so that collation overlaps with the training "
+                "step. Defaults to the number of CPUs per device, at most 8. 0 loads data in the main process."
+            )
+        },
+    )
+    dataloader_persistent_workers: Optional[bool] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Whether to keep the dataloader workers alive across epochs instead of restarting them. "
+                "Defaults to True when dataloader workers are used."
+            )
+        },
+    )
+    ddp_gradient_as_bucket_view: bool = field(
+        default=True,
+        metadata={
+            "help": (
+                "When using distributed training, whether gradients are views into the DDP allreduce buckets. "
+                "Saves one gradient-sized copy per step."
+            )
+        },
+    )
+    ddp_comm_hook: Optional[str] = field(
+        default="auto",
+        metadata={
+            "help": (
+                "When using distributed training, the DDP communication hook used to compress gradients "
+                "before allreduce. `auto` compresses to bf16/fp16 when training with --bf16/--fp16, "
+                "and does not compress full precision training."
+            ),
+            "choices": [None, "auto", "bf16", "fp16"],
+        },
+    )
+    use_fused_rmsnorm: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to replace the RMSNorm layers of the model with Liger's fused Triton kernel. "
+                "Has no effect when `--use_liger_kernel` is set, which already patches them."
+            )
+        },
+    )
+    torch_compile_per_layer: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to compile each decoder layer separately instead of the whole model. "
+                "Enabled automatically when `--torch_compile` is used together with `--gradient_checkpointing`."
+            )
+        },
+    )
     use_customized_optim: bool = field(default=False, metadata={"help": "whether to use customized optimizers."})
     customized_optim: str = field(default="sign_sgd", metadata={"help": "name of the customized optimizer."})
     customized_optim_args: str = field(default=None, metadata={"help": "optional arguments that are supplied."})
@@ -679,6 +765,63 @@ class FinetunerArguments(TrainingArguments):
         default=0, metadata={"help": "Weight decay (L2 penalty) added to the loss to prevent overfitting"}
     )
 
+    def __post_init__(self):
+        if getattr(self, "use_liger_kernel", False) and not is_liger_kernel_available():
+            self.use_liger_kernel = False
+            logger.warning(
+                "Liger kernel is not available in the current environment. Disabling the fused "
+                "cross entropy and norm kernels. If you want to use them, please install by "
+                "`pip install -e '.[liger]'`."
+            )
+
+        if self.optim == "adamw_torch" and torch.cuda.is_available() and not self.deepspeed:
+            # Single multi-tensor kernel for the whole parameter list instead of a
+            # per-parameter loop. DeepSpeed manages (and may offload) its own optimizer.
+            self.optim = "adamw_torch_fused"
+
+        if self.tf32 is None and is_torch_tf32_available():
+            self.tf32 = True
+
+        if self.dataloader_num_workers is None:
+            num_devices = max(1, torch.cuda.device_count())
+            self.dataloader_num_workers = min(8, (os.cpu_count() or 1) // num_devices)
+        if self.dataloader_persistent_workers is None:
+            self.dataloader_persistent_workers = self.dataloader_num_workers > 0
+        if self.dataloader_num_workers > 0 and getattr(self, "dataloader_prefetch_factor", 0) is None:
+            self.dataloader_prefetch_factor = 4
+
+        if self.ddp_bucket_cap_mb is None:
+            # Larger than the torch default (25MB): fewer, better overlapped allreduce calls.
+            self.ddp_bucket_cap_mb = 50
+
+        compile_mode, compile_backend = None, None
+        if self.torch_compile or self.torch_compile_mode is not None or self.torch_compile_backend is not None:
+            if self.torch_compile_mode is None:
+                # CUDA graphs conflict with the dynamic allocations of training steps.
+                self.torch_compile_mode = "max-autotune-no-cudagraphs"
+            if self.gradient_checkpointing and not self.torch_compile_per_layer:
+                # Compiling the whole model across checkpoint boundaries fails with
+                # `element 0 of tensors does not require grad and does not have a grad_fn`.
+                # Compile each decoder layer inside its checkpoint boundary instead.
+                logger.warning(
+                    "torch_compile is not supported together with gradient_checkpointing on the whole model. "
+                    "Compiling each decoder layer separately instead."
+                )
+                self.torch_compile_per_layer = True
+            if self.torch_compile_per_layer:
+                # Keep the HF Trainer from compiling the whole model as well.
+                compile_mode, compile_backend = self.torch_compile_mode, self.torch_compile_backend
+                self.torch_compile = False
+                self.torch_compile_mode = None
+                self.torch_compile_backend = None
+
+        super().__post_init__()
+
+        if self.torch_compile_per_layer:
+            # Restored after the parent checks, which would otherwise re-enable `torch_compile`.
+            self.torch_compile_mode = compile_mode
+            self.torch_compile_backend = compile_backend or "inductor"
+
 
 @dataclass
 class RewardModelTunerArguments(FinetunerArguments):
@@ -333,6 +333,20 @@ class Dataset:
             # If the backend is not Hugging Face, raise a NotImplementedError
             raise NotImplementedError(f'Currently .map is not supported for backend "{self.backend}"')
 
+    def shallow_copy(self):
+        r"""
+        Returns
+        ---------
+
+        A new Dataset object that shares the backend dataset with this one.
+        Hugging Face backend datasets are immutable Arrow tables, so there is
+        no need to duplicate them: `map()` on the copy rebinds its own
+        `backend_dataset` and leaves this dataset untouched.
+        """
+        dataset = copy.copy(self)
+        dataset.data_args = copy.copy(self.data_args)
+        return dataset
+
     def get_backend(self) -> Optional[str]:
         r"""
         Returns
@@ -6,17 +6,24 @@ from lmflow.models.hf_text_regression_model import HFTextRegressionModel
 
 # from lmflow.models.hf_encoder_decoder_model import HFEncoderDecoderModel
 
+MODEL_MAPPING = {
+    "decoder_only": HFDecoderModel,
+    "text_regression": HFTextRegressionModel,
+    # "encoder_decoder": HFEncoderDecoderModel,
+    # "vision_encoder_decoder": HFEncoderDecoderModel,
+}
+
 
 class AutoModel:
     @classmethod
-    def get_model(self, model_args, *args, **kwargs):
+    def register(cls, arch_type, model_class):
+        """Register a model class for an `arch_type`."""
+        MODEL_MAPPING[arch_type] = model_class
+
+    @classmethod
+    def get_model(cls, model_args, *args, **kwargs):
         arch_type = model_args.arch_type
-        if arch_type == "decoder_only":
-            return HFDecoderModel(model_args, *args, **kwargs)
-        elif arch_type == "text_regression":
-            return HFTextRegressionModel(model_args, *args, **kwargs)
-        # elif arch_type == "encoder_decoder" or \
-        #         arch_type == "vision_encoder_decoder":
-        #     return HFEncoderDecoderModel(model_args, *args, **kwargs)
-        else:
+        if arch_type not in MODEL_MAPPING:
             raise NotImplementedError(f'model architecture type "{arch_type}" is not supported')
+
+        return MODEL_MAPPING[arch_type](model_args, *args, **kwargs)
@@ -618,7 +618,7 @@ class HFDecoderModel(DecoderModel, HFModelMixin, Tunable):
                 torch_dtype=torch_dtype,
                 device_map=device_map,
                 trust_remote_code=self.model_args.trust_remote_code,
-                attn_implementation="flash_attention_2" if self.model_args.use_flash_attention else None,
+                attn_implementation=self.model_args.attn_implementation,
             )
 
             self.backend_model = PeftModel.from_pretrained(self.backend_model_full, tmpdirname)
@@ -176,7 +176,7 @@ class HFModelMixin(BaseModel):
             hf model config.
         """
         config_kwargs = {
-            "attn_implementation": "flash_attention_2" if model_args.use_flash_attention else None,
+            "attn_implementation": model_args.attn_implementation,
             "cache_dir": model_args.cache_dir,
             "revision": model_args.model_revision,
             "token": model_args.token,
@@ -397,6 +397,12 @@ class HFModelMixin(BaseModel):
         # TODO: change to accelerate
         logger.info("Preparing model for inference")
         inference_load_kwargs = {}
+        if self.device == "cpu":
+            # Build the model on the meta device and assign the (mmap'd) checkpoint
+            # tensors directly, instead of allocating randomly initialized weights
+            # first and copying the checkpoint into them. Roughly halves peak RAM
+            # for cpu workloads such as merging LoRA weights.
+            inference_load_kwargs["low_cpu_mem_usage"] = True
         inference_load_kwargs_bak = copy.deepcopy(inference_load_kwargs)
         ram_optimized_load_kwargs = {
             "device_map": "auto",
@@ -1,16 +1,20 @@
 #!/usr/bin/env python
-import copy
+import hashlib
+import inspect
 import logging
 import os
 import sys
-from copy import deepcopy
+from dataclasses import replace
 from itertools import chain
 from typing import Union
 
 import datasets
 import evaluate
+import numpy as np
+import pyarrow.compute as pc
 import torch
 import transformers
+from safetensors.torch import save_file
 from transformers import (
     Trainer,
     default_data_collator,
@@ -31,12 +35,50 @@ from lmflow.models.hf_decoder_model import HFDecoderModel
 from lmflow.models.hf_text_regression_model import HFTextRegressionModel
 from lmflow.optim import create_customized_optimizer
 from lmflow.pipeline.base_tuner import BaseTuner
+from lmflow.pipeline.utils.ddp_trainer import create_ddp_tuned_trainer
 from lmflow.pipeline.utils.lisa_trainer import DynamicLayerActivationCallback
+from lmflow.utils.model import apply_fused_rmsnorm, compile_decoder_layers
 from lmflow.utils.versioning import is_package_version_at_least
 
 logger = logging.getLogger(__name__)
 
 
+def group_texts(examples, block_size):
+    """Main data processing function that concatenates all texts of a batch and
+    generates chunks of `block_size`.
+
+    Defined at module level with `block_size` passed through `fn_kwargs`, so that
+    `datasets` pickles it by reference for `num_proc` workers and hashes it
+    cheaply for caching, instead of serializing a closure.
+    """
+    # Concatenate all texts into one flat buffer per key.
+    concatenated_examples = {k: np.fromiter(chain.from_iterable(v), dtype=np.int64) for k, v in examples.items()}
+    total_length = len(next(iter(concatenated_examples.values())))
+    # We drop the small remainder, we could add padding if the model
+    # supported it instead of this drop, you can customize this part to
+    # your needs.
+    total_length = (total_length // block_size) * block_size
+    # Split by chunks of max_len, as a strided view of the flat buffer.
+    return {k: t[:total_length].reshape(-1, block_size).tolist() for k, t in concatenated_examples.items()}
+
+
+# Number of rows held in the shuffle buffer of streaming datasets.
+STREAMING_SHUFFLE_BUFFER_SIZE = 10000
+
+
+def to_shuffled_iterable_dataset(dataset: datasets.Dataset, num_shards: int, seed: int) -> datasets.IterableDataset:
+    """Converts `dataset` to an `IterableDataset` that is shuffled like a map-style
+    dataset under the Trainer's random sampler.
+
+    The Trainer uses no sampler for an `IterableDataset`, so the shards are shuffled
+    and the rows go through a shuffle buffer. One shard per dataloader worker, since
+    the shards are distributed among the workers.
+    """
+    return dataset.to_iterable_dataset(num_shards=max(1, num_shards)).shuffle(
+        seed=seed, buffer_size=STREAMING_SHUFFLE_BUFFER_SIZE
+    )
+
+
 class Finetuner(BaseTuner):
     """
     Initializes the `Finetuner` class with given arguments.
@@ -172,23 +214,6 @@ class Finetuner(BaseTuner):
             else:
                 block_size = data_args.block_size
 
-        # Main data processing function that will concatenate all texts from
-        # our dataset and generate chunks of block_size.
-        def group_texts(examples):
-            # Concatenate all texts.
-            concatenated_examples = {k: list(chain(*examples[k])) for k in examples.keys()}
-            total_length = len(concatenated_examples[list(examples.keys())[0]])
-            # We drop the small remainder, we could add padding if the model
-            # supported it instead of this drop, you can customize this part to
-            # your needs.
-            total_length = (total_length // block_size) * block_size
-            # Split by chunks of max_len.
-            result = {
-                k: [t[i : i + block_size] for i in range(0, total_length, block_size)]
-                for k, t in concatenated_examples.items()
-            }
-            return result
-
         # Note that with `batched=True`, this map processes 1,000 texts
         # together, so group_texts throws away a remainder for each of those
         # groups of 1,000 texts. You can adjust that batch_size here but a
@@ -202,19 +227,34 @@ class Finetuner(BaseTuner):
             if data_args.disable_group_texts:
                 group_batch_size = 1
             if not data_args.streaming:
+                # A deterministic fingerprint lets `datasets` reuse the cached
+                # grouped dataset across runs instead of re-hashing the closure.
+                # The source of `group_texts` invalidates the cache when it changes.
+                fingerprint = hashlib.md5(
+                    (
+                        tokenized_datasets.get_fingerprint()
+                        + f"###block_size={block_size}"
+                        + f"###group_batch_size={group_batch_size}"
+                        + f"###group_texts={inspect.getsource(group_texts)}"
+                    ).encode("utf-8")
+                ).hexdigest()
                 lm_datasets = tokenized_datasets.map(
                     group_texts,
                     batched=True,
                     batch_size=group_batch_size,
-                    num_proc=data_args.preprocessing_num_workers,
+                    fn_kwargs={"block_size": block_size},
+                    # The dataset's own arguments, as the eval set may use fewer workers.
+                    num_proc=tokenized_datasets.get_data_args().preprocessing_num_workers,
                     load_from_cache_file=not data_args.overwrite_cache,
                     desc=f"Grouping texts in chunks of {block_size}",
+                    new_fingerprint=fingerprint,
                 )
             else:
                 lm_datasets = tokenized_datasets.map(
                     group_texts,
                     batched=True,
                     batch_size=group_batch_size,
+                    fn_kwargs={"block_size": block_size},
                 )
 
         return lm_datasets
@@ -235,14 +275,32 @@ class Finetuner(BaseTuner):
             TunableModel to perform tuning.
 
         dataset:
-            dataset to train model.
+            dataset to train model. With `--streaming` and `--max_steps`, its backend dataset
+            is converted to a shuffled `IterableDataset`, in place when `transform_dataset_in_place`.
 
         """
         model_args = self.model_args
         data_args = self.data_args
         finetuner_args = self.finetuner_args
         if not transform_dataset_in_place:
-            dataset = copy.deepcopy(dataset)
+            dataset = dataset.shallow_copy()
+
+        if data_args.streaming and dataset.backend == "huggingface":
+            if finetuner_args.max_steps > 0:
+                # Iterate over the raw dataset lazily, so that tokenization and
+                # grouping are fused into one pass over each batch without
+                # materializing the intermediate tokenized table.
+                dataset.backend_dataset = to_shuffled_iterable_dataset(
+                    dataset.get_backend_dataset(),
+                    num_shards=finetuner_args.dataloader_num_workers,
+                    seed=finetuner_args.seed,
+                )
+            else:
+                logger.warning(
+                    "Streaming tokenization requires `--max_steps`, since the number of training steps can not "
+                    "be derived from `--num_train_epochs` without the length of the dataset. Tokenizing the "
+                    "whole dataset up front instead."
+                )
 
         # Tokenization and text grouping must be done in the main process
         if dataset.backend == "custom_multi_modal":
@@ -260,8 +318,10 @@ class Finetuner(BaseTuner):
                     )
 
         train_dataset = lm_dataset.get_backend_dataset()
+        is_streaming = isinstance(train_dataset, datasets.IterableDataset)
 
         if data_args.calculate_dataset_stats:
+            total_samples = 0
             total_tokens = 0
             total_target_tokens = 0
             pad_token_id = model.get_tokenizer().pad_token_id
@@ -269,25 +329,37 @@ class Finetuner(BaseTuner):
             import time
 
             start_time = time.time()
-            for datapoint in train_dataset:
-                total_tokens += len([label for label in datapoint["input_ids"] if label != pad_token_id])
-                total_target_tokens += len([label for label in datapoint["labels"] if label != -100])
+            # Count over the flattened Arrow buffers batch by batch instead of
+            # iterating token by token in Python.
+            stats_dataset = train_dataset.select_columns(["input_ids", "labels"]).with_format("arrow")
+            for batch in stats_dataset.iter(batch_size=1024):
+                total_samples += batch.num_rows
+                input_ids = pc.list_flatten(batch["input_ids"]).to_numpy()
+                labels = pc.list_flatten(batch["labels"]).to_numpy()
+                total_tokens += int(np.count_nonzero(input_ids != pad_token_id))
+                total_target_tokens += int(np.count_nonzero(labels != -100))
             logger.warning(
                 "Dataset stats:\n\n"
                 f"Total tokens: {total_tokens}\n"
                 f"Total target tokens: {total_target_tokens}\n"
-                f"Total samples: {len(train_dataset)}\n"
-                f"Average tokens per sample: {total_tokens / len(train_dataset)}\n"
-                f"Average target tokens per sample: {total_target_tokens / len(train_dataset)}\n"
+                f"Total samples: {total_samples}\n"
+                f"Average tokens per sample: {total_tokens / total_samples}\n"
+                f"Average target tokens per sample: {total_target_tokens / total_samples}\n"
             )
             logger.warning("Calculating data stats took %s seconds", time.time() - start_time)
-        else:
+        elif not is_streaming:
             logger.warning(f"Number of train samples: {len(train_dataset)}")
 
         if finetuner_args.do_eval:
-            eval_dataset_args = deepcopy(data_args)
-            eval_dataset_args.dataset_path = finetuner_args.eval_dataset_path
+            eval_dataset_args = replace(data_args, dataset_path=finetuner_args.eval_dataset_path)
             eval_dataset = Dataset(eval_dataset_args)
+            if eval_dataset_args.preprocessing_num_workers is not None and not eval_dataset_args.streaming:
+                # Spawning many workers costs more than it saves on small eval sets.
+                # Tokenization and grouping fingerprints do not depend on the number
+                # of workers, so cached results are still reused.
+                eval_dataset_args.preprocessing_num_workers = min(
+                    eval_dataset_args.preprocessing_num_workers, max(1, len(eval_dataset) // 1000)
+                )
             with finetuner_args.main_process_first(desc="dataset map tokenization"):
                 tokenized_dataset = model.tokenize(eval_dataset)
                 if data_args.disable_group_texts:
@@ -305,7 +377,9 @@ class Finetuner(BaseTuner):
                     # Depending on the model and config, logits may contain extra tensors,
                     # like past_key_values, but logits always come first
                     logits = logits[0]
-                return logits.argmax(dim=-1)
+                # Reduce the vocab dimension chunk by chunk along the sequence to
+                # bound the temporary memory of argmax on large vocabularies.
+                return torch.cat([chunk.argmax(dim=-1) for chunk in logits.split(1024, dim=1)], dim=1)
 
             metric = evaluate.load("accuracy")
 
@@ -319,8 +393,11 @@ class Finetuner(BaseTuner):
 
         if finetuner_args.do_train:
             if data_args.max_train_samples is not None:
-                max_train_samples = min(len(train_dataset), data_args.max_train_samples)
-                train_dataset = train_dataset.select(range(max_train_samples))
+                if is_streaming:
+                    train_dataset = train_dataset.take(data_args.max_train_samples)
+                else:
+                    max_train_samples = min(len(train_dataset), data_args.max_train_samples)
+                    train_dataset = train_dataset.select(range(max_train_samples))
 
         if getattr(finetuner_args, "bf16", False) and not torch.cuda.is_bf16_supported():
             logger.warning(
@@ -347,8 +424,27 @@ class Finetuner(BaseTuner):
                 )
                 backend_model.resize_token_embeddings(len(tokenizer))
 
+        if finetuner_args.use_fused_rmsnorm and not getattr(finetuner_args, "use_liger_kernel", False):
+            apply_fused_rmsnorm(backend_model)
+
+        if finetuner_args.torch_compile_per_layer:
+            num_layers = compile_decoder_layers(
+                backend_model,
+                mode=finetuner_args.torch_compile_mode,
+                backend=finetuner_args.torch_compile_backend,
+            )
+            logger.info(f"Compiled {num_layers} decoder layers with torch.compile.")
+
+        if finetuner_args.ddp_find_unused_parameters is None and model_args.use_lora and not finetuner_args.use_lisa:
+            # Every trainable LoRA parameter receives a gradient, and the frozen base model is not
+            # registered with DDP at all, so there is nothing to search for. The search walks the
+            # autograd graph every step and delays the last allreduce bucket. Other runs keep the
+            # transformers default, since e.g. MoE routers may leave trainable parameters unused.
+            finetuner_args.ddp_find_unused_parameters = False
+
         # Initialize our Trainer
         training_args = finetuner_args
+
         FinetuningTrainer = Trainer
         trainer_callbacks = []
 
@@ -359,6 +455,9 @@ class Finetuner(BaseTuner):
             BaseTrainer = FinetuningTrainer
             FinetuningTrainer = create_customized_optimizer(BaseTrainer, model_args)
 
+        if training_args.ddp_gradient_as_bucket_view or training_args.ddp_comm_hook is not None:
+            FinetuningTrainer = create_ddp_tuned_trainer(FinetuningTrainer)
+
         if training_args.use_lisa:
             dynamic_layer_activation_callback = DynamicLayerActivationCallback(
                 n_layers=training_args.lisa_activated_layers,  # Number of layers to activate
@@ -405,15 +504,17 @@ class Finetuner(BaseTuner):
             # save language_projection for multi-modal model;
             if self.finetuner_args.save_language_projection:
                 language_projection_state = trainer.model.language_projection.state_dict()
-                torch.save(
-                    os.path.join(self.finetuner_args.output_dir, "language_projection.pth"), language_projection_state
+                save_file(
+                    {k: v.contiguous() for k, v in language_projection_state.items()},
+                    os.path.join(self.finetuner_args.output_dir, "language_projection.safetensors"),
                 )
             metrics = train_result.metrics
 
-            max_train_samples = (
-                data_args.max_train_samples if data_args.max_train_samples is not None else len(train_dataset)
-            )
-            metrics["train_samples"] = min(max_train_samples, len(train_dataset))
+            if not is_streaming:
+                max_train_samples = (
+                    data_args.max_train_samples if data_args.max_train_samples is not None else len(train_dataset)
+                )
+                metrics["train_samples"] = min(max_train_samples, len(train_dataset))
 
             trainer.log_metrics("train", metrics)
             trainer.save_metrics("train", metrics)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# Copyright 2024 Statistics and Machine Learning Research Group. All rights reserved.
+import logging
+
+from accelerate.utils import DistributedDataParallelKwargs
+from transformers.training_args import ParallelMode
+
+logger = logging.getLogger(__name__)
+
+
+# Names of the `accelerate.utils.DDPCommunicationHookType` members, which is only
+# available from accelerate 0.32.0 on and therefore imported when a hook is used.
+DDP_COMM_HOOK_MAPPING = {
+    "bf16": "BF16",
+    "fp16": "FP16",
+}
+
+
+def create_ddp_tuned_trainer(base_trainer_class):
+    """Returns a subclass of `base_trainer_class` whose DDP wrapping honors
+    `ddp_gradient_as_bucket_view` and `ddp_comm_hook` in the training arguments.
+
+    `_wrap_model` runs before the model is wrapped in DDP, so the override sets
+    `gradient_as_bucket_view` and the communication hook on the accelerator's
+    DDP kwargs handler, and the hook is registered on the DDP-wrapped model.
+    """
+
+    class DDPTunedTrainer(base_trainer_class):
+        def _wrap_model(self, model, training=True, dataloader=None):
+            model = super()._wrap_model(model, training=training, dataloader=dataloader)
+
+            if (
+                not training
+                or self.args.parallel_mode != ParallelMode.DISTRIBUTED
+                or self.is_deepspeed_enabled
+                or self.is_fsdp_enabled
+            ):
+                return model
+
+            if self.accelerator.ddp_handler is None:
+                self.accelerator.ddp_handler = DistributedDataParallelKwargs()
+            ddp_handler = self.accelerator.ddp_handler
+
+            # Gradients share storage with the allreduce buckets, which saves
+            # one copy and one gradient-sized buffer per step.
+            ddp_handler.gradient_as_bucket_view = self.args.ddp_gradient_as_bucket_view
+
+            comm_hook = self.args.ddp_comm_hook
+            is_auto = comm_hook == "auto"
+            if is_auto:
+                comm_hook = "bf16" if self.args.bf16 else "fp16" if self.args.fp16 else None
+            if comm_hook is not None:
+                try:
+                    from accelerate.utils import DDPCommunicationHookType
+                except ImportError as e:
+                    if not is_auto:
+                        raise ImportError(
+                            "`--ddp_comm_hook` requires accelerate>=0.32.0. "
+                            "Please upgrade via `pip install -U accelerate`."
+                        ) from e
+                    logger.warning("DDP communication hooks require accelerate>=0.32.0, not compressing gradients.")
+                    return model
+                ddp_handler.comm_hook = DDPCommunicationHookType[DDP_COMM_HOOK_MAPPING[comm_hook]]
+                logger.info(f"Registering {comm_hook} DDP communication hook.")
+
+            return model
+
+    return DDPTunedTrainer
@@ -2,7 +2,8 @@
 # Copyright 2024 Statistics and Machine Learning Research Group. All rights reserved.
 
 import logging
-from typing import Union
+from inspect import isfunction
+from typing import Optional, Union
 
 import transformers
 from transformers import PreTrainedTokenizer, PreTrainedTokenizerFast
@@ -10,7 +11,7 @@ from transformers.testing_utils import CaptureLogger
 
 from lmflow.args import DatasetArguments
 from lmflow.utils.constants import CONVERSATION_ROLE_NAMES
-from lmflow.utils.conversation_template import ConversationTemplate
+from lmflow.utils.conversation_template import ConversationTemplate, JinjaTemplate
 
 logger = logging.getLogger(__name__)
 tok_logger = transformers.utils.logging.get_logger("transformers.tokenization_utils_base")
@@ -108,6 +109,42 @@ def tokenize_function(
     return token_dict
 
 
+def _get_tool_schemas(tools: Optional[list]) -> Optional[list[dict]]:
+    """Validate the tools passed to a chat template the same way `apply_chat_template` does:
+    JSON schemas are used as is, and functions are converted to their schemas."""
+    if tools is None:
+        return None
+    tool_schemas = []
+    for tool in tools:
+        if isinstance(tool, dict):
+            tool_schemas.append(tool)
+        elif isfunction(tool):
+            from transformers.utils import get_json_schema
+
+            tool_schemas.append(get_json_schema(tool))
+        else:
+            raise ValueError(
+                "Tools should either be a JSON schema, or a callable function with type hints "
+                "and a docstring suitable for auto-conversion to a schema."
+            )
+    return tool_schemas
+
+
+def _generation_spans_to_mask(encoding, generation_spans: list[tuple[int, int]]) -> list[int]:
+    """Mark the tokens covering the character spans of the generation blocks, the same way
+    `tokenizer.apply_chat_template(return_assistant_tokens_mask=True)` does."""
+    mask = [0] * len(encoding["input_ids"])
+    for start_char, end_char in generation_spans:
+        start_token = encoding.char_to_token(start_char)
+        end_token = encoding.char_to_token(end_char - 1)
+        if start_token is None:
+            # start_token is out of bounds maybe due to truncation.
+            break
+        for token_idx in range(start_token, end_token + 1 if end_token else len(mask)):
+            mask[token_idx] = 1
+    return mask
+
+
 def conversation_tokenize_function(
     examples,
     data_args: DatasetArguments,
@@ -131,13 +168,24 @@ def conversation_tokenize_function(
             if isinstance(conversation_template, str):  # jinja template
                 conversation = [{"role": "system", "content": system}] if system is not None else []
                 conversation.extend(messages)
-                encoded_conversation = tokenizer.apply_chat_template(
-                    conversation=conversation,
-                    tools=tools,
-                    chat_template=conversation_template,
-                    return_assistant_tokens_mask=True,
-                    return_dict=True,
-                )
+                if isinstance(conversation_template, JinjaTemplate) and tokenizer.is_fast:
+                    # Same as `apply_chat_template` below, with the generation spans recorded in the
+                    # same render instead of a second pass over the rendered text.
+                    rendered, generation_spans = conversation_template.render_with_generation_spans(
+                        conversation, tools=_get_tool_schemas(tools), **tokenizer.special_tokens_map
+                    )
+                    encoded_conversation = tokenizer(rendered, add_special_tokens=False)
+                    encoded_conversation["assistant_masks"] = _generation_spans_to_mask(
+                        encoded_conversation, generation_spans
+                    )
+                else:
+                    encoded_conversation = tokenizer.apply_chat_template(
+                        conversation=conversation,
+                        tools=tools,
+                        chat_template=conversation_template,
+                        return_assistant_tokens_mask=True,
+                        return_dict=True,
+                    )
 
                 if data_args.train_on_prompt:
                     labels = encoded_conversation["input_ids"]
@@ -177,18 +225,19 @@ def conversation_tokenize_function(
                     tools=tools,
                 )
 
-                input_ids, labels = [], []
+                # Extend the output lists in place, instead of building a temporary list per turn.
+                input_ids, labels = token_dict["input_ids"][i], token_dict["labels"][i]
                 for turn_idx, (user_input, assistant_result) in enumerate(encoded_conversation):
-                    input_ids += user_input + assistant_result
+                    input_ids.extend(user_input)
+                    input_ids.extend(assistant_result)
 
                     if data_args.train_on_prompt:
-                        labels += user_input + assistant_result
+                        labels.extend(user_input)
                     else:
-                        labels += [-100] * len(user_input) + assistant_result
+                        labels.extend([-100] * len(user_input))
+                    labels.extend(assistant_result)
 
-                token_dict["input_ids"][i].extend(input_ids)
                 token_dict["attention_mask"][i].extend([1] * len(input_ids))
-                token_dict["labels"][i].extend(labels)
 
     if data_args.disable_group_texts:
         token_dict = blocking(
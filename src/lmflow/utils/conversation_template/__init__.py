@@ -4,6 +4,7 @@ import logging
 
 from lmflow.utils.versioning import is_package_version_at_least
 
+from ._jinja_env import JinjaTemplate, render_conversation
 from .base import EMPTY_NO_SPECIAL_TOKENS_TEMPLATE, EMPTY_TEMPLATE, ConversationTemplate, ConversationTemplateForTool
 from .chatglm import CHATGLM3_TEMPLATE
 from .chatml import CHATML_TEMPLATE
@@ -28,6 +29,8 @@ from .zephyr import ZEPHYR_TEMPLATE
 __all__ = [
     "ConversationTemplate",
     "ConversationTemplateForTool",
+    "JinjaTemplate",
+    "render_conversation",
 ]
 
 logger = logging.getLogger(__name__)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# Copyright 2024 Statistics and Machine Learning Research Group. All rights reserved.
+"""The jinja environment shared by the jinja chat templates, and `JinjaTemplate`."""
+
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime
+from functools import cache, lru_cache
+from typing import Optional
+
+from lmflow.utils.versioning import is_jinja_available
+
+# Directory to keep the compiled bytecode of the chat templates in across processes,
+# e.g. for dataloader and preprocessing workers. Disabled when not set. It can be
+# filled ahead of time with `python -m lmflow.utils.conversation_template.precompile`.
+JINJA_CACHE_DIR_ENV = "LMFLOW_JINJA_CACHE"
+# Number of rendered conversations to keep, for callers that render the same conversations
+# again. Disabled by default: dataset preprocessing renders each conversation once, and
+# `datasets.map` caches its output.
+RENDER_CACHE_SIZE_ENV = "LMFLOW_JINJA_RENDER_CACHE_SIZE"
+_RENDER_CACHE_SIZE = int(os.environ.get(RENDER_CACHE_SIZE_ENV, 0))
+_render_cache = OrderedDict()
+
+
+@cache
+def get_jinja_env():
+    """The environment shared by all jinja chat templates, set up the same way as the one
+    `transformers` uses for `apply_chat_template`, so that both render the same text.
+
+    Unlike the one in `transformers`, it is not sandboxed, since it only renders our own chat
+    templates (module constants) rather than ones downloaded with a model. For the same reason,
+    templates are never reloaded.
+    """
+    if not is_jinja_available():
+        raise ImportError("Rendering jinja chat templates requires jinja2. Please install via `pip install jinja2`.")
+
+    from jinja2 import Environment, FileSystemBytecodeCache, FunctionLoader, nodes, pass_context
+    from jinja2.exceptions import TemplateError
+    from jinja2.ext import Extension, loopcontrols
+
+    class GenerationExtension(Extension):
+        """Renders the body of `{% generation %}` blocks as is, and records where it is in the
+        output when rendered by `JinjaTemplate.render_with_generation_spans`."""
+
+        tags = {"generation"}
+
+        def parse(self, parser):
+            lineno = next(parser.stream).lineno
+            body = parser.parse_statements(["name:endgeneration"], drop_needle=True)
+            return nodes.CallBlock(self.call_method("_render_generation"), [], [], body).set_lineno(lineno)
+
+        @pass_context
+        def _render_generation(self, context, caller):
+            rendered = caller()
+            tracker = context.get(_GENERATION_TRACKER)
+            if tracker is not None:
+                tracker.spans.append((tracker.offset, tracker.offset + len(rendered)))
+            return rendered
+
+    class ReadOnlyTolerantBytecodeCache(FileSystemBytecodeCache):
+        """Does not fail when the cache can not be written, so that a cache directory filled ahead of
+        time (see `precompile.py`) can be used from a read-only filesystem."""
+
+        def dump_bytecode(self, bucket):
+            try:
+                super().dump_bytecode(bucket)
+            except OSError:
+                pass
+
+    def raise_exception(message):
+        raise TemplateError(message)
+
+    # `json.dumps` builds a new encoder on every call with non-default arguments.
+    json_encoder = json.JSONEncoder(ensure_ascii=False)
+
+    def tojson(x, ensure_ascii=False, indent=None, separators=None, sort_keys=False):
+        # Unlike jinja's builtin filter, does not escape html characters.
+        if not ensure_ascii and indent is None and separators is None and not sort_keys:
+            return json_encoder.encode(x)
+        return json.dumps(x, ensure_ascii=ensure_ascii, indent=indent, separators=separators, sort_keys=sort_keys)
+
+    def strftime_now(format):
+        return datetime.now().strftime(format)
+
+    bytecode_cache = None
+    cache_dir = os.environ.get(JINJA_CACHE_DIR_ENV)
+    if cache_dir:
+        cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        bytecode_cache = ReadOnlyTolerantBytecodeCache(directory=cache_dir, pattern="%s.cache")
+
+    env = Environment(
+        # Templates are looked up by their source, the bytecode cache is keyed by the
+        # hash of the name and validated against the checksum of the source.
+        loader=FunctionLoader(lambda source: (source, None, lambda: True)),
+        bytecode_cache=bytecode_cache,
+        # Chat templates are not html, and whitespace around tags is never part of the output.
+        autoescape=False,
+        trim_blocks=True,
+        lstrip_blocks=True,
+        keep_trailing_newline=False,
+        optimized=True,
+        auto_reload=False,
+        cache_size=400,
+        extensions=[GenerationExtension, loopcontrols],
+    )
+    env.filters["tojson"] = tojson
+    env.globals["raise_exception"] = raise_exception
+    env.globals["strftime_now"] = strftime_now
+    return env
+
+
+@cache
+def compile_jinja_template(source: str):
+    return get_jinja_env().get_template(str(source))
+
+
+# Name of the template variable holding the `_GenerationTracker` of a render.
+_GENERATION_TRACKER = "_lmflow_generation_tracker"
+
+
+class _GenerationTracker:
+    """The length of the output rendered so far, and the spans of the `{% generation %}` blocks in it."""
+
+    __slots__ = ("offset", "spans")
+
+    def __init__(self):
+        self.offset = 0
+        self.spans = []
+
+
+def _freeze(obj):
+    """A hashable key for (nested) message data. Dict key order and value types are
+    kept, since both can change the rendered text (e.g. `tojson`, `True` vs `1`)."""
+    if isinstance(obj, dict):
+        return (dict, tuple((key, _freeze(value)) for key, value in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return (list, tuple(_freeze(value) for value in obj))
+    return (type(obj), obj)
+
+
+def _thaw(key):
+    kind, value = key
+    if kind is dict:
+        return {name: _thaw(item) for name, item in value}
+    if kind is list:
+        return [_thaw(item) for item in value]
+    return value
+
+
+@lru_cache(maxsize=1024)
+def _tool_to_json(key) -> str:
+    return get_jinja_env().filters["tojson"](_thaw(key))
+
+
+def prepare_tools(tools: list) -> list[str]:
+    """The tools serialized the same way as `tool | tojson` in a template. The JSON strings are
+    cached by the value of each tool, so a schema shared by many conversations is dumped once."""
+    tools_json = []
+    for tool in tools:
+        try:
+            tools_json.append(_tool_to_json(_freeze(tool)))
+        except TypeError:  # unhashable values
+            tools_json.append(get_jinja_env().filters["tojson"](tool))
+    return tools_json
+
+
+def clear_render_cache():
+    _render_cache.clear()
+    _tool_to_json.cache_clear()
+
+
+class JinjaTemplate(str):
+    """A jinja chat template. Only for trusted templates, see `get_jinja_env`.
+
+    It is the template source itself, so it can be passed anywhere a template string is
+    expected, e.g. `tokenizer.apply_chat_template(chat_template=...)`. In addition, it can
+    be rendered directly with a template that is parsed and compiled only once per process.
+    """
+
+    @property
+    def compiled(self):
+        # Keyed by the template itself rather than `str(self)`, a copy whose hash is not cached.
+        return compile_jinja_template(self)
+
+    def render(
+        self,
+        messages: list[dict],
+        tools: Optional[list[dict]] = None,
+        add_generation_prompt: bool = False,
+        **kwargs,
+    ) -> str:
+        """Render a conversation. Extra keyword arguments (e.g. `enable_thinking`) are passed to the template.
+
+        When `LMFLOW_JINJA_RENDER_CACHE_SIZE` is set, the results are cached by the value of the
+        arguments, so rendering the same conversation again only costs building the cache key.
+        """
+        context = dict(messages=messages, tools=tools, add_generation_prompt=add_generation_prompt, **kwargs)
+        return self._cached_render(context, self.compiled)
+
+    def render_with_generation_spans(
+        self,
+        messages: list[dict],
+        tools: Optional[list[dict]] = None,
+        add_generation_prompt: bool = False,
+        **kwargs,
+    ) -> tuple[str, list[tuple[int, int]]]:
+        """Render a conversation like `render`, and also return the `(start, end)` character spans of
+        the `{% generation %}` blocks (i.e. the assistant outputs to train on) in the rendered text.
+
+        The spans are the same as the generation indices of `tokenizer.apply_chat_template`, but are
+        recorded while rendering, instead of joining the output rendered so far at every block.
+        """
+        context = dict(messages=messages, tools=tools, add_generation_prompt=add_generation_prompt, **kwargs)
+        rendered, spans = self._cached_render(context, self.compiled, with_spans=True)
+        return rendered, list(spans)
+
+    def batch_render(
+        self,
+        conversations: list[list[dict]],
+        tools: Optional[list[dict]] = None,
+        add_generation_prompt: bool = False,
+        **kwargs,
+    ) -> list[str]:
+        """Render a list of conversations sharing the same arguments, e.g. in a batched `datasets.map`.
+        Same as calling `render` for each of them, with the compiled template looked up once."""
+        compiled = self.compiled
+        return [
+            self._cached_render(
+                dict(messages=messages, tools=tools, add_generation_prompt=add_generation_prompt, **kwargs),
+                compiled,
+            )
+            for messages in conversations
+        ]
+
+    def _cached_render(self, context: dict, compiled, with_spans: bool = False):
+        if _RENDER_CACHE_SIZE <= 0:
+            return self._render(context, compiled, with_spans)
+
+        try:
+            key = (self, with_spans, _freeze(context))
+            rendered = _render_cache.get(key)
+        except TypeError:  # unhashable values
+            return self._render(context, compiled, with_spans)
+
+        if rendered is None:
+            rendered = self._render(context, compiled, with_spans)
+            _render_cache[key] = rendered
+            if len(_render_cache) > _RENDER_CACHE_SIZE:
+                _render_cache.popitem(last=False)
+        else:
+            _render_cache.move_to_end(key)
+        return rendered
+
+    def _render(self, context: dict, compiled, with_spans: bool = False):
+        # `Template.render` without copying the context into a new dict first.
+        context = self.prepare_context(context)
+        try:
+            if not with_spans:
+                return compiled.environment.concat(compiled.root_render_func(compiled.new_context(context)))
+
+            tracker = context[_GENERATION_TRACKER] = _GenerationTracker()
+            chunks = []
+            for chunk in compiled.root_render_func(compiled.new_context(context)):
+                chunks.append(chunk)
+                tracker.offset += len(chunk)
+            return compiled.environment.concat(chunks), tuple(tracker.spans)
+        except Exception:
+            return compiled.environment.handle_exception()
+
+    def prepare_context(self, context: dict) -> dict:
+        """Precompute template variables in python before rendering. Templates must still render
+        the same without them, as `tokenizer.apply_chat_template` does not call this."""
+        return context
+
+
+def render_conversation(
+    example: dict, conversation_template: JinjaTemplate, add_generation_prompt: bool = False
+) -> dict:
+    """Render an example of a conversation dataset (`messages`, and optionally `system` and `tools`)
+    into `{"text": ...}`.
+
+    It is a module level function, so that it can be pickled to worker processes, e.g.
+    `dataset.map(render_conversation, fn_kwargs={"conversation_template": ...}, num_proc=...)`.
+    Compiled templates (and rendered conversations, if enabled) are cached per process, forked workers
+    start with the ones of the parent.
+    """
+    messages = example["messages"]
+    system = example.get("system")
+    if system is not None:
+        messages = [{"role": "system", "content": system}, *messages]
+    rendered = conversation_template.render(
+        messages, tools=example.get("tools"), add_generation_prompt=add_generation_prompt
+    )
+    return {"text": rendered}
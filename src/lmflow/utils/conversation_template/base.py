@@ -113,11 +113,43 @@ class EmptyFormatter(Formatter):
         return self.template
 
 
+# Kinds of the flattened components of a `StringFormatter`: strings with placeholders to
+# fill in, and components that are passed through as is.
+_STRING = 0
+_AS_IS = 1
+
+
 @dataclass
 class StringFormatter(Formatter):
     def __post_init__(self):
         if not self.has_placeholder():
             raise ValueError("String formatter should have placeholders.")
+        self.compile()
+
+    def compile(self):
+        """Flatten the components into the kinds and payloads used by `format`, and reset the cache
+        of the literal pieces around the placeholders. Call again after changing `template`.
+        """
+        self._kinds = tuple(_STRING if component.type == "string" else _AS_IS for component in self.template)
+        self._payloads = tuple(
+            component.content if component.type == "string" else component for component in self.template
+        )
+        self._pieces = {}
+        # A single string component, e.g. `<|im_start|>user\n{{content}}<|im_end|>\n`, the common case.
+        self._single_string = self._kinds == (_STRING,)
+
+    def _get_pieces(self, key: str) -> list[Optional[list[str]]]:
+        """The string components split on the placeholder of `key`, computed once per key, so that
+        formatting is a single `str.join` instead of a search and replace."""
+        pieces = self._pieces.get(key)
+        if pieces is None:
+            placeholder = "{{" + key + "}}"
+            pieces = [
+                payload.split(placeholder) if kind == _STRING else None
+                for kind, payload in zip(self._kinds, self._payloads)
+            ]
+            self._pieces[key] = pieces
+        return pieces
 
     def format(self, **kwargs) -> list:
         """Format the string components with the provided keyword arguments.
@@ -133,11 +165,20 @@ class StringFormatter(Formatter):
         list
             Formatted template.
         """
+        if self._single_string and len(kwargs) == 1:
+            ((key, value),) = kwargs.items()
+            templated = value.join(self._get_pieces(key)[0])
+            if templated:
+                formatted_template = [TemplateComponent(type="string", content=templated)]
+                logger.debug(formatted_template)
+                return formatted_template
+
         formatted_template = []
-        for component in self.template:
-            if component.type == "string":
-                for key, value in kwargs.items():
-                    templated = component.content.replace("{{" + key + "}}", value)
+        values_and_pieces = [(value, self._get_pieces(key)) for key, value in kwargs.items()]
+        for index, (kind, payload) in enumerate(zip(self._kinds, self._payloads)):
+            if kind == _STRING:
+                for value, pieces in values_and_pieces:
+                    templated = value.join(pieces[index])
                     if len(templated) == 0:
                         logger.warning(
                             "Found empty string after formatting, adding a space instead. "
@@ -146,7 +187,7 @@ class StringFormatter(Formatter):
                         templated = " "
                     formatted_template.append(TemplateComponent(type="string", content=templated))
             else:
-                formatted_template.append(component)
+                formatted_template.append(payload)
 
         logger.debug(formatted_template)
         return formatted_template
@@ -472,31 +513,24 @@ class ConversationTemplateForTool(ConversationTemplate):
         else:
             system_formatted = self.system_formatter.format(content="") if self.force_system else []
         system_encoded = self._encode_template(system_formatted, tokenizer)
+        formatters = {
+            CONVERSATION_ROLE_NAMES["user"]: self.user_formatter,
+            CONVERSATION_ROLE_NAMES["function"]: self.function_formatter,
+            CONVERSATION_ROLE_NAMES["observation"]: self.observation_formatter,
+            CONVERSATION_ROLE_NAMES["assistant"]: self.assistant_formatter,
+        }
         ls_for_save = []
-        for i in range(0, len(messages), 1):
-            if messages[i]["role"] == CONVERSATION_ROLE_NAMES["user"]:
-                user_message = messages[i]
-                user_formatted = self.user_formatter.format(content=user_message["content"])
-                user_encoded = self._encode_template(user_formatted, tokenizer)
-                if i == 0:
-                    user_encoded = system_encoded + user_encoded
-                ls_for_save.append(user_encoded)
-            elif messages[i]["role"] == CONVERSATION_ROLE_NAMES["function"]:
-                function_message = messages[i]
-                function_formatted = self.function_formatter.format(content=function_message["content"])
-                function_encoded = self._encode_template(function_formatted, tokenizer)
-                ls_for_save.append(function_encoded)
-            elif messages[i]["role"] == CONVERSATION_ROLE_NAMES["observation"]:
-                observation_message = messages[i]
-                observation_formatted = self.observation_formatter.format(content=observation_message["content"])
-                observation_encoded = self._encode_template(observation_formatted, tokenizer)
-                ls_for_save.append(observation_encoded)
-            elif messages[i]["role"] == CONVERSATION_ROLE_NAMES["assistant"]:
-                assistant_message = messages[i]
-                assistant_formatted = self.assistant_formatter.format(content=assistant_message["content"])
-                assistant_encoded = self._encode_template(assistant_formatted, tokenizer)
-                ls_for_save.append(assistant_encoded)
-                # res_tuple = (ls_for_save[0], ls_for_save[1], ls_for_save[2], ls_for_save[3])
+        for i, message in enumerate(messages):
+            role = message["role"]
+            formatter = formatters.get(role)
+            if formatter is None:
+                continue
+            encoded = self._encode_template(formatter.format(content=message["content"]), tokenizer)
+            if i == 0 and role == CONVERSATION_ROLE_NAMES["user"]:
+                encoded = system_encoded + encoded
+            ls_for_save.append(encoded)
+            if role == CONVERSATION_ROLE_NAMES["assistant"]:
+                # A turn ends with the assistant message, e.g. (user, function, observation, assistant)
                 res_all.append(tuple(ls_for_save))
                 ls_for_save = []
 
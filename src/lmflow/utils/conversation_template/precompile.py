@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# Copyright 2024 Statistics and Machine Learning Research Group. All rights reserved.
+"""Fill the jinja bytecode cache with the preset jinja chat templates ahead of time, e.g. when
+building a docker image, so that no process has to compile them on startup.
+
+Usage:
+    python -m lmflow.utils.conversation_template.precompile /path/to/cache
+    export LMFLOW_JINJA_CACHE=/path/to/cache
+
+The bytecode is specific to the python version, so fill the cache with the same interpreter that
+uses it. Entries written by other versions are ignored and compiled again.
+"""
+
+import argparse
+import os
+
+from . import PRESET_TEMPLATES
+from ._jinja_env import JINJA_CACHE_DIR_ENV, JinjaTemplate, compile_jinja_template
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the jinja bytecode cache with the preset chat templates.")
+    parser.add_argument(
+        "cache_dir",
+        nargs="?",
+        default=os.environ.get(JINJA_CACHE_DIR_ENV),
+        help=f"Cache directory, defaults to ${JINJA_CACHE_DIR_ENV}.",
+    )
+    args = parser.parse_args()
+    if not args.cache_dir:
+        parser.error(f"Please pass a cache directory or set ${JINJA_CACHE_DIR_ENV}.")
+
+    # The environment picks up the cache directory when it is created, on the first compile.
+    os.environ[JINJA_CACHE_DIR_ENV] = args.cache_dir
+    names = [name for name, template in PRESET_TEMPLATES.items() if isinstance(template, JinjaTemplate)]
+    for name in names:
+        compile_jinja_template(PRESET_TEMPLATES[name])
+    print(f"Compiled {len(names)} chat templates into {os.path.expanduser(args.cache_dir)}: {', '.join(names)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,414 +1,257 @@
 #!/usr/bin/env python
 # Copyright 2024 Statistics and Machine Learning Research Group. All rights reserved.
+import json
 
-
+from ._jinja_env import JinjaTemplate, prepare_tools
 from .base import ConversationTemplate, ConversationTemplateForTool, StringFormatter, TemplateComponent
 
+_USER_TURN = "<|im_start|>user\n{{content}}<|im_end|>\n"
+_ASSISTANT_TURN = "<|im_start|>assistant\n{{content}}<|im_end|>\n"
+_SYSTEM_TURN = "<|im_start|>system\n{{content}}<|im_end|>\n"
+_TOOL_TURN = "<|im_start|>tool\n{{content}}<|im_end|>\n"
+
 QWEN2_TEMPLATE = ConversationTemplate(
     template_name="qwen2",
-    user_formatter=StringFormatter(
-        template=[TemplateComponent(type="string", content="<|im_start|>user\n{{content}}<|im_end|>\n")]
-    ),
-    assistant_formatter=StringFormatter(
-        template=[TemplateComponent(type="string", content="<|im_start|>assistant\n{{content}}<|im_end|>\n")]
-    ),
-    system_formatter=StringFormatter(
-        template=[TemplateComponent(type="string", content="<|im_start|>system\n{{content}}<|im_end|>\n")]
-    ),
+    user_formatter=StringFormatter(template=[TemplateComponent(type="string", content=_USER_TURN)]),
+    assistant_formatter=StringFormatter(template=[TemplateComponent(type="string", content=_ASSISTANT_TURN)]),
+    system_formatter=StringFormatter(template=[TemplateComponent(type="string", content=_SYSTEM_TURN)]),
     separator=TemplateComponent(type="string", content="\n"),
 )
 
 
+# Shares the formatters of `QWEN2_TEMPLATE`, and with them their cache of split placeholders.
 QWEN2_TEMPLATE_FOR_TOOL = ConversationTemplateForTool(
     template_name="qwen2_for_tool",
-    user_formatter=StringFormatter(
-        template=[TemplateComponent(type="string", content="<|im_start|>user\n{{content}}<|im_end|>\n")]
-    ),
-    function_formatter=StringFormatter(
-        template=[TemplateComponent(type="string", content="<|im_start|>assistant\n{{content}}<|im_end|>\n")]
-    ),
-    observation_formatter=StringFormatter(
-        template=[TemplateComponent(type="string", content="<|im_start|>tool\n{{content}}<|im_end|>\n")]
-    ),
-    assistant_formatter=StringFormatter(
-        template=[TemplateComponent(type="string", content="<|im_start|>assistant\n{{content}}<|im_end|>\n")]
-    ),
-    system_formatter=StringFormatter(
-        template=[TemplateComponent(type="string", content="<|im_start|>system\n{{content}}<|im_end|>\n")]
-    ),
+    user_formatter=QWEN2_TEMPLATE.user_formatter,
+    function_formatter=QWEN2_TEMPLATE.assistant_formatter,
+    observation_formatter=StringFormatter(template=[TemplateComponent(type="string", content=_TOOL_TURN)]),
+    assistant_formatter=QWEN2_TEMPLATE.assistant_formatter,
+    system_formatter=QWEN2_TEMPLATE.system_formatter,
     separator=TemplateComponent(type="string", content="\n"),
 )
 
 
-QWEN2_5_TEMPLATE = (
-    "{%- if tools %}"
-    "{{- '<|im_start|>system\\n' }}"
-    "{%- if messages[0]['role'] == 'system' %}"
-    "{{- messages[0]['content'] }}"
-    "{%- else %}"
-    "{{- 'You are Qwen, created by Alibaba Cloud. You are a helpful assistant.' }}"
-    "{%- endif %}"
-    '{{- "\\n\\n# Tools\\n\\nYou may call one or more functions to assist with the user query.\\n\\nYou are provided with function signatures within <tools></tools> XML tags:\\n<tools>" }}'
-    "{%- for tool in tools %}"
-    '{{- "\\n" }}'
-    "{{- tool | tojson }}"
-    "{%- endfor %}"
-    '{{- "\\n</tools>\\n\\nFor each function call, return a json object with function name and arguments within <tool_call></tool_call> XML tags:\\n<tool_call>\\n{\\"name\\": <function-name>, \\"arguments\\": <args-json-object>}\\n</tool_call><|im_end|>\\n" }}'
-    "{%- else %}"
-    "{%- if messages[0]['role'] == 'system' %}"
-    "{{- '<|im_start|>system\\n' + messages[0]['content'] + '<|im_end|>\\n' }}"
-    "{%- else %}"
-    "{{- '<|im_start|>system\\nYou are Qwen, created by Alibaba Cloud. You are a helpful assistant.<|im_end|>\\n' }}"
-    "{%- endif %}"
-    "{%- endif %}"
-    "{%- for message in messages %}"
-    '{%- if (message.role == "user") or (message.role == "system" and not loop.first) or (message.role == "assistant" and not message.tool_calls) %}'
-    '{%- if message.role == "assistant" %}'
-    "{{- '<|im_start|>' + message.role + '\\n' }}"
-    "{% generation %}"
-    "{{ message.content + '<|im_end|>' + '\\n' }}"
-    "{% endgeneration %}"
-    "{%- else %}"
-    "{{- '<|im_start|>' + message.role + '\\n' + message.content + '<|im_end|>' + '\\n' }}"
-    "{%- endif %}"
-    '{%- elif message.role == "assistant" %}'
-    "{{- '<|im_start|>' + message.role }}"
-    "{%- if message.content %}"
-    "{% generation %}"
-    "{{- '\\n' + message.content }}"
-    "{% endgeneration %}"
-    "{%- endif %}"
-    "{%- for tool_call in message.tool_calls %}"
-    "{%- if tool_call.function is defined %}"
-    "{%- set tool_call = tool_call.function %}"
-    "{%- endif %}"
-    "{% generation %}"
-    '{{- \'\\n<tool_call>\\n{"name": "\' }}'
-    "{{- tool_call.name }}"
-    '{{- \'", "arguments": \' }}'
-    "{{- tool_call.arguments | tojson }}"
-    "{{- '}\\n</tool_call>' }}"
-    "{% endgeneration %}"
-    "{%- endfor %}"
-    "{% generation %}"
-    "{{- '<|im_end|>\\n' }}"
-    "{% endgeneration %}"
-    '{%- elif message.role == "tool" %}'
-    '{%- if (loop.index0 == 0) or (messages[loop.index0 - 1].role != "tool") %}'
-    "{{- '<|im_start|>user' }}"
-    "{%- endif %}"
-    "{{- '\\n<tool_response>\\n' }}"
-    "{{- message.content }}"
-    "{{- '\\n</tool_response>' }}"
-    '{%- if loop.last or (messages[loop.index0 + 1].role != "tool") %}'
-    "{{- '<|im_end|>\\n' }}"
-    "{%- endif %}"
-    "{%- endif %}"
-    "{%- endfor %}"
-    "{%- if add_generation_prompt %}"
-    "{{- '<|im_start|>assistant\\n' }}"
-    "{%- endif %}"
+# Pieces of template source shared by the Qwen2.5 and Qwen3 chat templates.
+_TOOLS_INSTRUCTION = (
+    "# Tools\\n\\nYou may call one or more functions to assist with the user query.\\n\\n"
+    "You are provided with function signatures within <tools></tools> XML tags:\\n<tools>"
+)
+_TOOLS_LIST = (
+    "{% if tools_json is defined %}"
+    "{% for tool_json in tools_json %}"
+    '{{ "\\n" + tool_json }}'
+    "{% endfor %}"
+    "{% else %}"
+    "{% for tool in tools %}"
+    '{{ "\\n" }}'
+    "{{ tool | tojson }}"
+    "{% endfor %}"
+    "{% endif %}"
+    '{{ "\\n</tools>\\n\\nFor each function call, return a json object with function name and arguments within '
+    '<tool_call></tool_call> XML tags:\\n<tool_call>\\n{\\"name\\": <function-name>, \\"arguments\\": '
+    '<args-json-object>}\\n</tool_call><|im_end|>\\n" }}'
+)
+# The tool responses, consecutive ones are put into a single user turn.
+_TOOL_RESPONSE = (
+    '{% elif message.role == "tool" %}'
+    '{% if loop.first or (loop.previtem.role != "tool") %}'
+    "{{ '<|im_start|>user' }}"
+    "{% endif %}"
+    "{{ '\\n<tool_response>\\n' }}"
+    "{{ message.content }}"
+    "{{ '\\n</tool_response>' }}"
+    '{% if loop.last or (loop.nextitem.role != "tool") %}'
+    "{{ '<|im_end|>\\n' }}"
+    "{% endif %}"
 )
 
 
-QWEN2_5_1M_TEMPLATE = (
-    "{%- if tools %}"
-    "{{- '<|im_start|>system\\n' }}"
-    "{%- if messages[0]['role'] == 'system' %}"
-    "{{- messages[0]['content'] }}"
-    "{%- else %}"
-    "{{- 'You are a helpful assistant.' }}"
-    "{%- endif %}"
-    '{{- "\\n\\n# Tools\\n\\nYou may call one or more functions to assist with the user query.\\n\\nYou are provided with function signatures within <tools></tools> XML tags:\\n<tools>" }}'
-    "{%- for tool in tools %}"
-    '{{- "\\n" }}'
-    "{{- tool | tojson }}"
-    "{%- endfor %}"
-    '{{- "\\n</tools>\\n\\nFor each function call, return a json object with function name and arguments within <tool_call></tool_call> XML tags:\\n<tool_call>\\n{\\"name\\": <function-name>, \\"arguments\\": <args-json-object>}\\n</tool_call><|im_end|>\\n" }}'
-    "{%- else %}"
-    "{%- if messages[0]['role'] == 'system' %}"
-    "{{- '<|im_start|>system\\n' + messages[0]['content'] + '<|im_end|>\\n' }}"
-    "{%- else %}"
-    "{{- '<|im_start|>system\\nYou are a helpful assistant.<|im_end|>\\n' }}"
-    "{%- endif %}"
-    "{%- endif %}"
-    "{%- for message in messages %}"
-    '{%- if (message.role == "user") or (message.role == "system" and not loop.first) or (message.role == "assistant" and not message.tool_calls) %}'
-    '{%- if message.role == "assistant" %}'
-    "{{- '<|im_start|>' + message.role + '\\n' }}"
-    "{% generation %}"
-    "{{ message.content + '<|im_end|>' + '\\n' }}"
-    "{% endgeneration %}"
-    "{%- else %}"
-    "{{- '<|im_start|>' + message.role + '\\n' + message.content + '<|im_end|>' + '\\n' }}"
-    "{%- endif %}"
-    '{%- elif message.role == "assistant" %}'
-    "{{- '<|im_start|>' + message.role }}"
-    "{%- if message.content %}"
-    "{% generation %}"
-    "{{- '\\n' + message.content }}"
-    "{% endgeneration %}"
-    "{%- endif %}"
-    "{%- for tool_call in message.tool_calls %}"
-    "{%- if tool_call.function is defined %}"
-    "{%- set tool_call = tool_call.function %}"
-    "{%- endif %}"
-    "{% generation %}"
-    '{{- \'\\n<tool_call>\\n{"name": "\' }}'
-    "{{- tool_call.name }}"
-    '{{- \'", "arguments": \' }}'
-    "{{- tool_call.arguments | tojson }}"
-    "{{- '}\\n</tool_call>' }}"
-    "{% endgeneration %}"
-    "{%- endfor %}"
-    "{% generation %}"
-    "{{- '<|im_end|>\\n' }}"
-    "{% endgeneration %}"
-    '{%- elif message.role == "tool" %}'
-    '{%- if (loop.index0 == 0) or (messages[loop.index0 - 1].role != "tool") %}'
-    "{{- '<|im_start|>user' }}"
-    "{%- endif %}"
-    "{{- '\\n<tool_response>\\n' }}"
-    "{{- message.content }}"
-    "{{- '\\n</tool_response>' }}"
-    '{%- if loop.last or (messages[loop.index0 + 1].role != "tool") %}'
-    "{{- '<|im_end|>\\n' }}"
-    "{%- endif %}"
-    "{%- endif %}"
-    "{%- endfor %}"
-    "{%- if add_generation_prompt %}"
-    "{{- '<|im_start|>assistant\\n' }}"
-    "{%- endif %}"
-)
+class QwenTemplate(JinjaTemplate):
+    def prepare_context(self, context: dict) -> dict:
+        # Tool schemas are usually shared by many conversations, serialize each one only once.
+        if context.get("tools"):
+            context["tools_json"] = prepare_tools(context["tools"])
+        return context
 
 
-QWEN2_5_MATH_TEMPLATE = (
-    "{%- if tools %}"
-    "{{- '<|im_start|>system\\n' }}"
-    "{%- if messages[0]['role'] == 'system' %}"
-    "{{- messages[0]['content'] }}"
-    "{%- else %}"
-    "{{- 'Please reason step by step, and put your final answer within \\\\boxed{}.' }}"
-    "{%- endif %}"
-    '{{- "\\n\\n# Tools\\n\\nYou may call one or more functions to assist with the user query.\\n\\nYou are provided with function signatures within <tools></tools> XML tags:\\n<tools>" }}'
-    "{%- for tool in tools %}"
-    '{{- "\\n" }}'
-    "{{- tool | tojson }}"
-    "{%- endfor %}"
-    '{{- "\\n</tools>\\n\\nFor each function call, return a json object with function name and arguments within <tool_call></tool_call> XML tags:\\n<tool_call>\\n{\\"name\\": <function-name>, \\"arguments\\": <args-json-object>}\\n</tool_call><|im_end|>\\n" }}'
-    "{%- else %}"
-    "{%- if messages[0]['role'] == 'system' %}"
-    "{{- '<|im_start|>system\\n' + messages[0]['content'] + '<|im_end|>\\n' }}"
-    "{%- else %}"
-    "{{- '<|im_start|>system\\nPlease reason step by step, and put your final answer within \\\\boxed{}.<|im_end|>\\n' }}"
-    "{%- endif %}"
-    "{%- endif %}"
-    "{%- for message in messages %}"
-    '{%- if (message.role == "user") or (message.role == "system" and not loop.first) or (message.role == "assistant" and not message.tool_calls) %}'
-    '{%- if message.role == "assistant" %}'
-    "{{- '<|im_start|>' + message.role + '\\n' }}"
-    "{% generation %}"
-    "{{ message.content + '<|im_end|>' + '\\n' }}"
-    "{% endgeneration %}"
-    "{%- else %}"
-    "{{- '<|im_start|>' + message.role + '\\n' + message.content + '<|im_end|>' + '\\n' }}"
-    "{%- endif %}"
-    '{%- elif message.role == "assistant" %}'
-    "{{- '<|im_start|>' + message.role }}"
-    "{%- if message.content %}"
-    "{% generation %}"
-    "{{- '\\n' + message.content }}"
-    "{% endgeneration %}"
-    "{%- endif %}"
-    "{%- for tool_call in message.tool_calls %}"
-    "{%- if tool_call.function is defined %}"
-    "{%- set tool_call = tool_call.function %}"
-    "{%- endif %}"
-    "{% generation %}"
-    '{{- \'\\n<tool_call>\\n{"name": "\' }}'
-    "{{- tool_call.name }}"
-    '{{- \'", "arguments": \' }}'
-    "{{- tool_call.arguments | tojson }}"
-    "{{- '}\\n</tool_call>' }}"
-    "{% endgeneration %}"
-    "{%- endfor %}"
-    "{% generation %}"
-    "{{- '<|im_end|>\\n' }}"
-    "{% endgeneration %}"
-    '{%- elif message.role == "tool" %}'
-    '{%- if (loop.index0 == 0) or (messages[loop.index0 - 1].role != "tool") %}'
-    "{{- '<|im_start|>user' }}"
-    "{%- endif %}"
-    "{{- '\\n<tool_response>\\n' }}"
-    "{{- message.content }}"
-    "{{- '\\n</tool_response>' }}"
-    '{%- if loop.last or (messages[loop.index0 + 1].role != "tool") %}'
-    "{{- '<|im_end|>\\n' }}"
-    "{%- endif %}"
-    "{%- endif %}"
-    "{%- endfor %}"
-    "{%- if add_generation_prompt %}"
-    "{{- '<|im_start|>assistant\\n' }}"
-    "{%- endif %}"
-)
+def _qwen2_5_template(default_system: str) -> QwenTemplate:
+    """The Qwen2.5 chat template, the model variants only differ in the default system prompt."""
+    return QwenTemplate(
+        "{% set default_system = " + json.dumps(default_system) + " %}"
+        "{% if tools %}"
+        "{{ '<|im_start|>system\\n' }}"
+        "{% if messages[0]['role'] == 'system' %}"
+        "{{ messages[0]['content'] }}"
+        "{% else %}"
+        "{{ default_system }}"
+        "{% endif %}"
+        '{{ "\\n\\n' + _TOOLS_INSTRUCTION + '" }}' + _TOOLS_LIST + "{% else %}"
+        "{% if messages[0]['role'] == 'system' %}"
+        "{{ '<|im_start|>system\\n' + messages[0]['content'] + '<|im_end|>\\n' }}"
+        "{% else %}"
+        "{{ '<|im_start|>system\\n' + default_system + '<|im_end|>\\n' }}"
+        "{% endif %}"
+        "{% endif %}"
+        "{% for message in messages %}"
+        '{% if (message.role == "user") or (message.role == "system" and not loop.first) or (message.role == "assistant" and not message.tool_calls) %}'
+        '{% if message.role == "assistant" %}'
+        "{{ '<|im_start|>assistant\\n' }}"
+        "{% generation %}"
+        "{{ message.content + '<|im_end|>\\n' }}"
+        "{% endgeneration %}"
+        "{% else %}"
+        "{{ '<|im_start|>' + message.role + '\\n' + message.content + '<|im_end|>\\n' }}"
+        "{% endif %}"
+        '{% elif message.role == "assistant" %}'
+        "{{ '<|im_start|>assistant' }}"
+        "{% if message.content %}"
+        "{% generation %}"
+        "{{ '\\n' + message.content }}"
+        "{% endgeneration %}"
+        "{% endif %}"
+        "{% for tool_call in message.tool_calls %}"
+        "{% if tool_call.function is defined %}"
+        "{% set tool_call = tool_call.function %}"
+        "{% endif %}"
+        "{% generation %}"
+        '{{ \'\\n<tool_call>\\n{"name": "\' }}'
+        "{{ tool_call.name }}"
+        '{{ \'", "arguments": \' }}'
+        "{{ tool_call.arguments | tojson }}"
+        "{{ '}\\n</tool_call>' }}"
+        "{% endgeneration %}"
+        "{% endfor %}"
+        "{% generation %}"
+        "{{ '<|im_end|>\\n' }}"
+        "{% endgeneration %}" + _TOOL_RESPONSE + "{% endif %}"
+        "{% endfor %}"
+        "{% if add_generation_prompt %}"
+        "{{ '<|im_start|>assistant\\n' }}"
+        "{% endif %}"
+    )
 
 
-QWEN_QWQ_TEMPLATE = (
-    "{%- if tools %}"
-    "{{- '<|im_start|>system\\n' }}"
-    "{%- if messages[0]['role'] == 'system' %}"
-    "{{- messages[0]['content'] }}"
-    "{%- else %}"
-    "{{- 'You are a helpful and harmless assistant. You are Qwen developed by Alibaba. You should think step-by-step.' }}"
-    "{%- endif %}"
-    '{{- "\\n\\n# Tools\\n\\nYou may call one or more functions to assist with the user query.\\n\\nYou are provided with function signatures within <tools></tools> XML tags:\\n<tools>" }}'
-    "{%- for tool in tools %}"
-    '{{- "\\n" }}'
-    "{{- tool | tojson }}"
-    "{%- endfor %}"
-    '{{- "\\n</tools>\\n\\nFor each function call, return a json object with function name and arguments within <tool_call></tool_call> XML tags:\\n<tool_call>\\n{\\"name\\": <function-name>, \\"arguments\\": <args-json-object>}\\n</tool_call><|im_end|>\\n" }}'
-    "{%- else %}"
-    "{%- if messages[0]['role'] == 'system' %}"
-    "{{- '<|im_start|>system\\n' + messages[0]['content'] + '<|im_end|>\\n' }}"
-    "{%- else %}"
-    "{{- '<|im_start|>system\\nYou are a helpful and harmless assistant. You are Qwen developed by Alibaba. You should think step-by-step.<|im_end|>\\n' }}"
-    "{%- endif %}"
-    "{%- endif %}"
-    "{%- for message in messages %}"
-    '{%- if (message.role == "user") or (message.role == "system" and not loop.first) or (message.role == "assistant" and not message.tool_calls) %}'
-    '{%- if message.role == "assistant" %}'
-    "{{- '<|im_start|>' + message.role + '\\n' }}"
-    "{% generation %}"
-    "{{ message.content + '<|im_end|>' + '\\n' }}"
-    "{% endgeneration %}"
-    "{%- else %}"
-    "{{- '<|im_start|>' + message.role + '\\n' + message.content + '<|im_end|>' + '\\n' }}"
-    "{%- endif %}"
-    '{%- elif message.role == "assistant" %}'
-    "{{- '<|im_start|>' + message.role }}"
-    "{%- if message.content %}"
-    "{% generation %}"
-    "{{- '\\n' + message.content }}"
-    "{% endgeneration %}"
-    "{%- endif %}"
-    "{%- for tool_call in message.tool_calls %}"
-    "{%- if tool_call.function is defined %}"
-    "{%- set tool_call = tool_call.function %}"
-    "{%- endif %}"
-    "{% generation %}"
-    '{{- \'\\n<tool_call>\\n{"name": "\' }}'
-    "{{- tool_call.name }}"
-    '{{- \'", "arguments": \' }}'
-    "{{- tool_call.arguments | tojson }}"
-    "{{- '}\\n</tool_call>' }}"
-    "{% endgeneration %}"
-    "{%- endfor %}"
-    "{% generation %}"
-    "{{- '<|im_end|>\\n' }}"
-    "{% endgeneration %}"
-    '{%- elif message.role == "tool" %}'
-    '{%- if (loop.index0 == 0) or (messages[loop.index0 - 1].role != "tool") %}'
-    "{{- '<|im_start|>user' }}"
-    "{%- endif %}"
-    "{{- '\\n<tool_response>\\n' }}"
-    "{{- message.content }}"
-    "{{- '\\n</tool_response>' }}"
-    '{%- if loop.last or (messages[loop.index0 + 1].role != "tool") %}'
-    "{{- '<|im_end|>\\n' }}"
-    "{%- endif %}"
-    "{%- endif %}"
-    "{%- endfor %}"
-    "{%- if add_generation_prompt %}"
-    "{{- '<|im_start|>assistant\\n' }}"
-    "{%- endif %}"
+QWEN2_5_TEMPLATE = _qwen2_5_template("You are Qwen, created by Alibaba Cloud. You are a helpful assistant.")
+
+QWEN2_5_1M_TEMPLATE = _qwen2_5_template("You are a helpful assistant.")
+
+QWEN2_5_MATH_TEMPLATE = _qwen2_5_template("Please reason step by step, and put your final answer within \\boxed{}.")
+
+QWEN_QWQ_TEMPLATE = _qwen2_5_template(
+    "You are a helpful and harmless assistant. You are Qwen developed by Alibaba. You should think step-by-step."
 )
 
-QWEN3_TEMPLATE = (
-    "{%- if tools %}"
-    "{{- '<|im_start|>system\\n' }}"
-    "{%- if messages[0].role == 'system' %}"
-    "{{- messages[0].content + '\\n\\n' }}"
-    "{%- endif %}"
-    '{{- "# Tools\\n\\nYou may call one or more functions to assist with the user query.\\n\\nYou are provided with function signatures within <tools></tools> XML tags:\\n<tools>" }}'
-    "{%- for tool in tools %}"
-    '{{- "\\n" }}'
-    "{{- tool | tojson }}"
-    "{%- endfor %}"
-    '{{- "\\n</tools>\\n\\nFor each function call, return a json object with function name and arguments within <tool_call></tool_call> XML tags:\\n<tool_call>\\n{\\"name\\": <function-name>, \\"arguments\\": <args-json-object>}\\n</tool_call><|im_end|>\\n" }}'
-    "{%- else %}"
-    "{%- if messages[0].role == 'system' %}"
-    "{{- '<|im_start|>system\\n' + messages[0].content + '<|im_end|>\\n' }}"
-    "{%- endif %}"
-    "{%- endif %}"
-    "{%- set ns = namespace(multi_step_tool=true, last_query_index=messages|length - 1) %}"
-    "{%- for message in messages[::-1] %}"
-    "{%- set index = (messages|length - 1) - loop.index0 %}"
-    "{%- if ns.multi_step_tool and message.role == \"user\" and not(message.content.startswith('<tool_response>') and message.content.endswith('</tool_response>')) %}"
-    "{%- set ns.multi_step_tool = false %}"
-    "{%- set ns.last_query_index = index %}"
-    "{%- endif %}"
-    "{%- endfor %}"
-    "{%- for message in messages %}"
-    '{%- if (message.role == "user") or (message.role == "system" and not loop.first) %}'
-    "{{- '<|im_start|>' + message.role + '\\n' + message.content + '<|im_end|>' + '\\n' }}"
-    '{%- elif message.role == "assistant" %}'
+
+def split_think(messages: list[dict]) -> list[dict]:
+    """Split the `<think>...</think>` part of the assistant messages without `reasoning_content`
+    into `reasoning_content`, the same way the Qwen3 chat template does. The messages are not
+    modified, the ones that are split are copied."""
+    split_messages = []
+    for message in messages:
+        content = message.get("content")
+        if (
+            message.get("role") == "assistant"
+            and message.get("reasoning_content") is None
+            and isinstance(content, str)
+            and "</think>" in content
+        ):
+            reasoning_content, _, content = content.partition("</think>")
+            message = dict(message)
+            message["reasoning_content"] = reasoning_content.rstrip("\n").split("<think>")[-1].lstrip("\n")
+            message["content"] = content.split("</think>")[-1].lstrip("\n")
+        split_messages.append(message)
+    return split_messages
+
+
+class Qwen3Template(QwenTemplate):
+    def prepare_context(self, context: dict) -> dict:
+        context = super().prepare_context(context)
+        context["messages"] = split_think(context["messages"])
+        # Index of the last user query, i.e. the last user message that is not a tool response.
+        # Reasoning content is only kept for the assistant messages after it.
+        messages = context["messages"]
+        context["last_query_index"] = len(messages) - 1
+        for index in range(len(messages) - 1, -1, -1):
+            message = messages[index]
+            content = message.get("content")
+            if message["role"] == "user" and not (
+                isinstance(content, str)
+                and content.startswith("<tool_response>")
+                and content.endswith("</tool_response>")
+            ):
+                context["last_query_index"] = index
+                break
+        return context
+
+
+QWEN3_TEMPLATE = Qwen3Template(
+    "{% if tools %}"
+    "{{ '<|im_start|>system\\n' }}"
+    "{% if messages[0].role == 'system' %}"
+    "{{ messages[0].content + '\\n\\n' }}"
+    "{% endif %}"
+    '{{ "' + _TOOLS_INSTRUCTION + '" }}' + _TOOLS_LIST + "{% else %}"
+    "{% if messages[0].role == 'system' %}"
+    "{{ '<|im_start|>system\\n' + messages[0].content + '<|im_end|>\\n' }}"
+    "{% endif %}"
+    "{% endif %}"
+    "{% if last_query_index is not defined %}"
+    "{% set ns = namespace(last_query_index=messages|length - 1) %}"
+    "{% for message in messages %}"
+    "{% if message.role == \"user\" and not(message.content.startswith('<tool_response>') and message.content.endswith('</tool_response>')) %}"
+    "{% set ns.last_query_index = loop.index0 %}"
+    "{% endif %}"
+    "{% endfor %}"
+    "{% set last_query_index = ns.last_query_index %}"
+    "{% endif %}"
+    "{% for message in messages %}"
+    '{% if (message.role == "user") or (message.role == "system" and not loop.first) %}'
+    "{{ '<|im_start|>' + message.role + '\\n' + message.content + '<|im_end|>\\n' }}"
+    '{% elif message.role == "assistant" %}'
     "{% generation %}"
-    "{%- set content = message.content %}"
-    "{%- set reasoning_content = '' %}"
-    "{%- if message.reasoning_content is defined and message.reasoning_content is not none %}"
-    "{%- set reasoning_content = message.reasoning_content %}"
-    "{%- else %}"
-    "{%- if '</think>' in message.content %}"
-    "{%- set content = message.content.split('</think>')[-1].lstrip('\\n') %}"
-    "{%- set reasoning_content = message.content.split('</think>')[0].rstrip('\\n').split('<think>')[-1].lstrip('\\n') %}"
-    "{%- endif %}"
-    "{%- endif %}"
-    "{%- if loop.index0 > ns.last_query_index %}"
-    "{%- if loop.last or (not loop.last and reasoning_content) %}"
-    "{{- '<|im_start|>' + message.role + '\\n<think>\\n' + reasoning_content.strip('\\n') + '\\n</think>\\n\\n' + content.lstrip('\\n') }}"
-    "{%- else %}"
-    "{{- '<|im_start|>' + message.role + '\\n' + content }}"
-    "{%- endif %}"
-    "{%- else %}"
-    "{{- '<|im_start|>' + message.role + '\\n' + content }}"
-    "{%- endif %}"
-    "{%- if message.tool_calls %}"
-    "{%- for tool_call in message.tool_calls %}"
-    "{%- if (loop.first and content) or (not loop.first) %}"
-    "{{- '\\n' }}"
-    "{%- endif %}"
-    "{%- if tool_call.function %}"
-    "{%- set tool_call = tool_call.function %}"
-    "{%- endif %}"
-    '{{- \'<tool_call>\\n{"name": "\' }}'
-    "{{- tool_call.name }}"
-    '{{- \'", "arguments": \' }}'
-    "{%- if tool_call.arguments is string %}"
-    "{{- tool_call.arguments }}"
-    "{%- else %}"
-    "{{- tool_call.arguments | tojson }}"
-    "{%- endif %}"
-    "{{- '}\\n</tool_call>' }}"
-    "{%- endfor %}"
-    "{%- endif %}"
-    "{{- '<|im_end|>\\n' }}"
-    "{% endgeneration %}"
-    '{%- elif message.role == "tool" %}'
-    '{%- if loop.first or (messages[loop.index0 - 1].role != "tool") %}'
-    "{{- '<|im_start|>user' }}"
-    "{%- endif %}"
-    "{{- '\\n<tool_response>\\n' }}"
-    "{{- message.content }}"
-    "{{- '\\n</tool_response>' }}"
-    '{%- if loop.last or (messages[loop.index0 + 1].role != "tool") %}'
-    "{{- '<|im_end|>\\n' }}"
-    "{%- endif %}"
-    "{%- endif %}"
-    "{%- endfor %}"
-    "{%- if add_generation_prompt %}"
-    "{{- '<|im_start|>assistant\\n' }}"
-    "{%- if enable_thinking is defined and enable_thinking is false %}"
-    "{{- '<think>\\n\\n</think>\\n\\n' }}"
-    "{%- endif %}"
-    "{%- endif %}"
+    "{% set content = message.content %}"
+    "{% set reasoning_content = '' %}"
+    "{% if message.reasoning_content is defined and message.reasoning_content is not none %}"
+    "{% set reasoning_content = message.reasoning_content %}"
+    "{% elif '</think>' in message.content %}"
+    "{% set content = message.content.split('</think>')[-1].lstrip('\\n') %}"
+    "{% set reasoning_content = message.content.split('</think>')[0].rstrip('\\n').split('<think>')[-1].lstrip('\\n') %}"
+    "{% endif %}"
+    "{% if loop.index0 > last_query_index %}"
+    "{% if loop.last or (not loop.last and reasoning_content) %}"
+    "{{ '<|im_start|>assistant\\n<think>\\n' + reasoning_content.strip('\\n') + '\\n</think>\\n\\n' + content.lstrip('\\n') }}"
+    "{% else %}"
+    "{{ '<|im_start|>assistant\\n' + content }}"
+    "{% endif %}"
+    "{% else %}"
+    "{{ '<|im_start|>assistant\\n' + content }}"
+    "{% endif %}"
+    "{% if message.tool_calls %}"
+    "{% for tool_call in message.tool_calls %}"
+    "{% if (loop.first and content) or (not loop.first) %}"
+    "{{ '\\n' }}"
+    "{% endif %}"
+    "{% if tool_call.function %}"
+    "{% set tool_call = tool_call.function %}"
+    "{% endif %}"
+    '{{ \'<tool_call>\\n{"name": "\' }}'
+    "{{ tool_call.name }}"
+    '{{ \'", "arguments": \' }}'
+    "{% if tool_call.arguments is string %}"
+    "{{ tool_call.arguments }}"
+    "{% else %}"
+    "{{ tool_call.arguments | tojson }}"
+    "{% endif %}"
+    "{{ '}\\n</tool_call>' }}"
+    "{% endfor %}"
+    "{% endif %}"
+    "{{ '<|im_end|>\\n' }}"
+    "{% endgeneration %}" + _TOOL_RESPONSE + "{% endif %}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}"
+    "{{ '<|im_start|>assistant\\n' }}"
+    "{% if enable_thinking is defined and enable_thinking is false %}"
+    "{{ '<think>\\n\\n</think>\\n\\n' }}"
+    "{% endif %}"
+    "{% endif %}"
 )
@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 # Copyright 2024 Statistics and Machine Learning Research Group. All rights reserved.
+import json
 import logging
+import os
+import shutil
+from typing import Optional
 
-from transformers import AutoTokenizer
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+from transformers import MODEL_FOR_CAUSAL_LM_MAPPING, AutoConfig, AutoTokenizer, PreTrainedModel
 
 from lmflow.args import ModelArguments
+from lmflow.utils.versioning import is_liger_kernel_available
 
 logger = logging.getLogger(__name__)
 
@@ -21,3 +29,184 @@ def check_homogeneity(model_args_list: list[ModelArguments]) -> bool:
         tokenizer_names.append(tokenizer.__class__.__name__)
 
     return len(set(tokenizer_names)) == 1
+
+
+def apply_fused_rmsnorm(model: PreTrainedModel) -> None:
+    """Swap the RMSNorm modules of a decoder model for Liger's fused Triton RMSNorm in place.
+
+    Only the norms are patched, the rest of the model (rope, mlp, loss) is left as is.
+    Use `--use_liger_kernel` to patch all supported modules instead.
+    """
+    if not is_liger_kernel_available():
+        raise ImportError("Liger kernel is not available. Please install via `pip install -e '.[liger]'`.")
+
+    from liger_kernel.transformers import _apply_liger_kernel_to_instance
+
+    if hasattr(model, "get_base_model"):  # peft model
+        model = model.get_base_model()
+
+    # Options that are not in the signature of the model specific patch
+    # function are dropped by liger.
+    _apply_liger_kernel_to_instance(
+        model=model,
+        rms_norm=True,
+        rope=False,
+        swiglu=False,
+        geglu=False,
+        cross_entropy=False,
+        fused_linear_cross_entropy=False,
+    )
+
+
+def compile_decoder_layers(model: PreTrainedModel, mode: Optional[str] = None, backend: str = "inductor") -> int:
+    """Compile the `forward` of each decoder layer of the model in place, and return the number of compiled layers.
+
+    With gradient checkpointing, each layer is a checkpoint boundary. Compiling the layers
+    one by one lets Inductor fuse the norm, attention and MLP kernels of a layer without
+    tracing across the boundaries, which fails for the whole model.
+    """
+    if hasattr(model, "get_base_model"):  # peft model
+        model = model.get_base_model()
+
+    # HF models list their decoder layer classes as the modules that must not be split.
+    layer_class_names = set(getattr(model, "_no_split_modules", None) or [])
+    if not layer_class_names:
+        logger.warning(f"Cannot find the decoder layers of {model.__class__.__name__}, skipping torch.compile.")
+        return 0
+
+    num_layers = 0
+    for module in model.modules():
+        if module.__class__.__name__ in layer_class_names:
+            module.forward = torch.compile(module.forward, mode=mode, backend=backend, dynamic=False)
+            num_layers += 1
+    return num_layers
+
+
+def _get_base_model_prefix(model_name_or_path: str) -> Optional[str]:
+    """The `base_model_prefix` of the causal LM class of a checkpoint, e.g. `transformer` for gpt2."""
+    try:
+        config = AutoConfig.from_pretrained(model_name_or_path)
+        return MODEL_FOR_CAUSAL_LM_MAPPING[type(config)].base_model_prefix
+    except (KeyError, OSError, ValueError):
+        return None
+
+
+def merge_lora_weights_streaming(
+    model_name_or_path: str,
+    lora_model_path: str,
+    output_model_path: str,
+    torch_dtype: Optional[torch.dtype] = None,
+) -> None:
+    """Merge a LoRA adapter into a safetensors checkpoint one shard at a time.
+
+    The base model is never instantiated: each shard is read, the `scale * B @ A`
+    deltas of the tensors it contains are added, and the shard is written out and
+    released before the next one is read. Peak memory is about one checkpoint shard
+    plus the adapter, instead of the whole model in full precision.
+
+    Parameters
+    ------------
+    model_name_or_path : str
+        Local directory of the base model, stored as safetensors.
+
+    lora_model_path : str
+        Directory of the peft LoRA adapter.
+
+    output_model_path : str
+        Directory to write the merged model to. Shard names and the weight index
+        are kept the same as the base model.
+
+    torch_dtype : torch.dtype, optional
+        dtype of the merged weights. Defaults to the dtype of each base tensor.
+    """
+    if not os.path.isdir(model_name_or_path):
+        raise ValueError(f"Streaming merge requires a local model directory, got `{model_name_or_path}`.")
+    shard_files = sorted(f for f in os.listdir(model_name_or_path) if f.endswith(".safetensors"))
+    if not shard_files:
+        raise ValueError(f"No safetensors weights found in `{model_name_or_path}`.")
+
+    with open(os.path.join(lora_model_path, "adapter_config.json")) as f:
+        adapter_config = json.load(f)
+    if (
+        adapter_config.get("rank_pattern")
+        or adapter_config.get("alpha_pattern")
+        or adapter_config.get("use_dora")
+        or adapter_config.get("lora_bias")
+    ):
+        raise NotImplementedError("Streaming merge does not support rank/alpha patterns, DoRA or LoRA bias adapters.")
+    rank = adapter_config["r"]
+    scale = adapter_config["lora_alpha"] / (rank**0.5 if adapter_config.get("use_rslora") else rank)
+    fan_in_fan_out = adapter_config.get("fan_in_fan_out", False)
+
+    adapter_file = os.path.join(lora_model_path, "adapter_model.safetensors")
+    if os.path.exists(adapter_file):
+        adapter_state_dict = load_file(adapter_file)
+    else:
+        adapter_state_dict = torch.load(os.path.join(lora_model_path, "adapter_model.bin"), map_location="cpu")
+
+    checkpoint_keys = set()
+    for shard_file in shard_files:
+        with safe_open(os.path.join(model_name_or_path, shard_file), framework="pt") as f:
+            checkpoint_keys.update(f.keys())
+    base_model_prefix = _get_base_model_prefix(model_name_or_path)
+
+    def to_checkpoint_key(key: str) -> str:
+        # Adapter keys name the modules of the full model, e.g. `transformer.h.0.attn.c_attn`,
+        # while some checkpoints (e.g. gpt2) store the base model without its prefix.
+        if key not in checkpoint_keys and base_model_prefix and key.startswith(base_model_prefix + "."):
+            stripped_key = key[len(base_model_prefix) + 1 :]
+            if stripped_key in checkpoint_keys:
+                return stripped_key
+        return key
+
+    # Adapter keys look like `base_model.model.<module>.lora_A.weight`, while the
+    # base checkpoint stores `<module>.weight`.
+    lora_pairs = {}
+    replaced_weights = {}
+    for key, tensor in adapter_state_dict.items():
+        key = key.removeprefix("base_model.model.")
+        if key.endswith((".lora_A.weight", ".lora_B.weight")):
+            module_name, lora_part = key.split(".lora_", 1)
+            lora_pairs.setdefault(to_checkpoint_key(f"{module_name}.weight"), {})[lora_part[0]] = tensor
+        elif "lora_" in key:
+            raise NotImplementedError(f"Streaming merge does not support adapter weight `{key}`.")
+        else:
+            # `modules_to_save` are fully trained copies that replace the base module.
+            replaced_weights[to_checkpoint_key(key.replace(".modules_to_save", ""))] = tensor
+
+    missing_keys = sorted((lora_pairs.keys() | replaced_weights.keys()) - checkpoint_keys)
+    if missing_keys:
+        raise ValueError(
+            f"{len(missing_keys)} adapter weights do not match any weight of the base model, "
+            f"e.g. {missing_keys[:3]}. Please check that the adapter was trained on `{model_name_or_path}`."
+        )
+
+    os.makedirs(output_model_path, exist_ok=True)
+    merged = 0
+    for shard_file in shard_files:
+        shard = {}
+        with safe_open(os.path.join(model_name_or_path, shard_file), framework="pt") as f:
+            for key in f.keys():
+                weight = replaced_weights.get(key)
+                if weight is None:
+                    weight = f.get_tensor(key)
+                if key in lora_pairs:
+                    lora_a, lora_b = lora_pairs[key]["A"], lora_pairs[key]["B"]
+                    delta = lora_b.float() @ lora_a.float()
+                    if fan_in_fan_out:
+                        delta = delta.T
+                    weight = weight.float().add_(delta, alpha=scale).to(weight.dtype)
+                    merged += 1
+                shard[key] = weight if torch_dtype is None else weight.to(torch_dtype)
+        save_file(shard, os.path.join(output_model_path, shard_file), metadata={"format": "pt"})
+        del shard
+        logger.info(f"Merged {shard_file}")
+
+    if merged != len(lora_pairs):
+        raise RuntimeError(f"Merged {merged} of {len(lora_pairs)} LoRA modules.")
+
+    # Config, tokenizer and the weight index are unchanged.
+    for file_name in os.listdir(model_name_or_path):
+        file_path = os.path.join(model_name_or_path, file_name)
+        if os.path.isfile(file_path) and not file_name.endswith((".safetensors", ".bin", ".pt")):
+            shutil.copy(file_path, output_model_path)
@@ -69,6 +69,14 @@ def is_flash_attn_available():
     return _is_package_available("flash_attn", skippable=True)
 
 
+def is_liger_kernel_available():
+    return _is_package_available("liger_kernel", skippable=True)
+
+
+def is_jinja_available():
+    return _is_package_available("jinja2")
+
+
 def is_flask_available():
     return _is_packages_available(["flask", "flask_cors"])
 
@@ -54,3 +54,19 @@ class DatasetTest(unittest.TestCase):
         }
         with self.assertRaises(ValueError):
             dataset = Dataset.create_from_dict(data_dict)
+
+    def test_shallow_copy(self):
+        data_dict = {
+            "type": "text2text",
+            "instances": [
+                {"input": "INPUT 1", "output": "OUTPUT 1"},
+                {"input": "INPUT 2", "output": "OUTPUT 2"},
+            ],
+        }
+        dataset = Dataset.create_from_dict(data_dict)
+        dataset_copy = dataset.shallow_copy()
+        self.assertIs(dataset_copy.get_backend_dataset(), dataset.get_backend_dataset())
+
+        dataset_copy.map(lambda example: {"output": example["output"].lower()})
+        self.assertEqual(dataset.to_dict(), data_dict)
+        self.assertEqual(dataset_copy.to_dict()["instances"][0]["output"], "output 1")
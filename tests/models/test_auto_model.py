@@ -1,7 +1,7 @@
 import unittest
 
 from lmflow.args import ModelArguments
-from lmflow.models.auto_model import AutoModel
+from lmflow.models.auto_model import MODEL_MAPPING, AutoModel
 from lmflow.models.hf_decoder_model import HFDecoderModel
 
 # from lmflow.models.hf_encoder_decoder_model import HFEncoderDecoderModel
@@ -33,6 +33,17 @@ class AutoModelTest(unittest.TestCase):
         self.assertTrue(isinstance(model, HFEncoderDecoderModel))
     """
 
+    def test_register_model(self):
+        class DummyModel:
+            def __init__(self, model_args, *args, **kwargs):
+                self.model_args = model_args
+
+        AutoModel.register("dummy", DummyModel)
+        self.addCleanup(MODEL_MAPPING.pop, "dummy")
+        model_args = ModelArguments(arch_type="dummy", model_name_or_path=MODEL_NAME)
+        model = AutoModel.get_model(model_args)
+        self.assertTrue(isinstance(model, DummyModel))
+
     def test_get_unsupported_model(self):
         model_args = ModelArguments(arch_type="unsupported model", model_name_or_path=MODEL_NAME)
         with self.assertRaises(NotImplementedError):
@@ -0,0 +1,66 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+from torch.nn.parallel import DistributedDataParallel
+from transformers.training_args import ParallelMode
+
+from lmflow.pipeline.utils.ddp_trainer import create_ddp_tuned_trainer
+
+
+class BaseTrainer:
+    is_deepspeed_enabled = False
+    is_fsdp_enabled = False
+
+    def __init__(self, **args):
+        self.args = SimpleNamespace(
+            parallel_mode=ParallelMode.DISTRIBUTED,
+            ddp_gradient_as_bucket_view=True,
+            ddp_comm_hook="auto",
+            bf16=False,
+            fp16=False,
+        )
+        vars(self.args).update(args)
+        self.accelerator = SimpleNamespace(ddp_handler=None)
+
+    def _wrap_model(self, model, training=True, dataloader=None):
+        return model
+
+
+DDPTunedTrainer = create_ddp_tuned_trainer(BaseTrainer)
+
+
+class DDPTunedTrainerTest(unittest.TestCase):
+    def wrap_and_register(self, trainer):
+        model = object()
+        self.assertIs(trainer._wrap_model(model), model)
+        ddp_model = MagicMock(spec=DistributedDataParallel)
+        trainer.accelerator.ddp_handler.register_comm_hook(ddp_model)
+        return ddp_model
+
+    def test_auto_comm_hook(self):
+        trainer = DDPTunedTrainer(bf16=True)
+        ddp_model = self.wrap_and_register(trainer)
+        ddp_model.register_comm_hook.assert_called_once_with(state=None, hook=default_hooks.bf16_compress_hook)
+        self.assertTrue(trainer.accelerator.ddp_handler.gradient_as_bucket_view)
+
+    def test_explicit_comm_hook(self):
+        trainer = DDPTunedTrainer(ddp_comm_hook="fp16", bf16=True)
+        ddp_model = self.wrap_and_register(trainer)
+        ddp_model.register_comm_hook.assert_called_once_with(state=None, hook=default_hooks.fp16_compress_hook)
+
+    def test_no_comm_hook(self):
+        trainer = DDPTunedTrainer(ddp_gradient_as_bucket_view=False)
+        ddp_model = self.wrap_and_register(trainer)
+        ddp_model.register_comm_hook.assert_not_called()
+        self.assertFalse(trainer.accelerator.ddp_handler.gradient_as_bucket_view)
+
+    def test_not_distributed(self):
+        trainer = DDPTunedTrainer(parallel_mode=ParallelMode.NOT_DISTRIBUTED, bf16=True)
+        trainer._wrap_model(object())
+        self.assertIsNone(trainer.accelerator.ddp_handler)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+
+import datasets
+
+from lmflow.pipeline.finetuner import to_shuffled_iterable_dataset
+
+
+class ToShuffledIterableDatasetTest(unittest.TestCase):
+    def setUp(self):
+        self.dataset = datasets.Dataset.from_dict({"text": [str(i) for i in range(100)]})
+
+    def test_shuffled(self):
+        iterable_dataset = to_shuffled_iterable_dataset(self.dataset, num_shards=4, seed=42)
+        self.assertIsInstance(iterable_dataset, datasets.IterableDataset)
+        self.assertEqual(iterable_dataset.num_shards, 4)
+        texts = [example["text"] for example in iterable_dataset]
+        self.assertNotEqual(texts, self.dataset["text"])
+        self.assertCountEqual(texts, self.dataset["text"])
+
+    def test_seed(self):
+        texts = [example["text"] for example in to_shuffled_iterable_dataset(self.dataset, num_shards=4, seed=42)]
+        self.assertEqual(
+            [example["text"] for example in to_shuffled_iterable_dataset(self.dataset, num_shards=4, seed=42)],
+            texts,
+        )
+
+    def test_no_workers(self):
+        iterable_dataset = to_shuffled_iterable_dataset(self.dataset, num_shards=0, seed=42)
+        self.assertEqual(iterable_dataset.num_shards, 1)
+        self.assertNotEqual([example["text"] for example in iterable_dataset], self.dataset["text"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,11 @@
+import pickle
 import unittest
+from unittest.mock import patch
 
 from transformers import AutoTokenizer
 
-from lmflow.utils.conversation_template import PRESET_TEMPLATES
+from lmflow.tokenization.hf_decoder_model import _get_tool_schemas
+from lmflow.utils.conversation_template import PRESET_TEMPLATES, JinjaTemplate, _jinja_env, render_conversation
 
 CONVERSATION_SINGLETURN = {
     "system": "sysinfo",
@@ -183,5 +186,116 @@ class Qwen2ConversationTemplateTest(unittest.TestCase):
         print("===")
 
 
+class QwenJinjaTemplateTest(unittest.TestCase):
+    def setUp(self):
+        MODEL_PATH = "Qwen/Qwen2.5-0.5B-Instruct"
+        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
+
+    def test_render_matches_apply_chat_template(self):
+        messages = [{"role": "system", "content": CONVERSATION_MULTITURN["system"]}]
+        messages.extend(CONVERSATION_MULTITURN["messages"])
+        for template_name in ["qwen2_5", "qwen2_5_1m", "qwen2_5_math", "qwen_qwq", "qwen3"]:
+            conversation_template = PRESET_TEMPLATES[template_name]
+            self.assertIsInstance(conversation_template, JinjaTemplate)
+            self.assertEqual(
+                conversation_template.render(messages),
+                self.tokenizer.apply_chat_template(messages, chat_template=conversation_template, tokenize=False),
+            )
+
+
+def get_weather(city: str):
+    """Get the current weather of a city.
+
+    Args:
+        city: The name of the city.
+    """
+
+
+class JinjaTemplateTest(unittest.TestCase):
+    """Tests of rendering jinja templates directly, without a tokenizer."""
+
+    def setUp(self):
+        self.conversation_template = JinjaTemplate(
+            "{% for message in messages %}"
+            "{{ message.role + ': ' }}"
+            '{% if message.role == "assistant" %}'
+            "{% generation %}{{ message.content + '\\n' }}{% endgeneration %}"
+            "{% else %}"
+            "{{ message.content + '\\n' }}"
+            "{% endif %}"
+            "{% endfor %}"
+            "{% for tool in tools or [] %}{{ tool | tojson }}{% endfor %}"
+        )
+
+    def test_jinja_env(self):
+        jinja_env = _jinja_env.get_jinja_env()
+        self.assertIs(self.conversation_template.compiled.environment, jinja_env)
+        self.assertFalse(jinja_env.auto_reload)
+        self.assertFalse(jinja_env.sandboxed)
+
+    def test_render(self):
+        self.assertEqual(
+            self.conversation_template.render(CONVERSATION_SINGLETURN["messages"], tools=[{"name": "é"}]),
+            'user: Hello\nassistant: Hi!\n{"name": "é"}',
+        )
+
+    def test_render_with_generation_spans(self):
+        messages = CONVERSATION_MULTITURN["messages"]
+        rendered, generation_spans = self.conversation_template.render_with_generation_spans(messages)
+        self.assertEqual(rendered, self.conversation_template.render(messages))
+        self.assertEqual([rendered[start:end] for start, end in generation_spans], ["Hi!\n", "I'm good, thanks!\n"])
+
+        num_assistant_messages = sum(message["role"] == "assistant" for message in messages)
+        for template_name in ["qwen2_5", "qwen3"]:
+            conversation_template = PRESET_TEMPLATES[template_name]
+            rendered, generation_spans = conversation_template.render_with_generation_spans(messages)
+            self.assertEqual(rendered, conversation_template.render(messages))
+            self.assertEqual(len(generation_spans), num_assistant_messages)
+            for start, end in generation_spans:
+                self.assertTrue(rendered[start:end].endswith("<|im_end|>\n"))
+
+    def test_render_conversation(self):
+        conversation_template = pickle.loads(pickle.dumps(PRESET_TEMPLATES["qwen3"]))
+        messages = [{"role": "system", "content": CONVERSATION_MULTITURN["system"]}]
+        messages.extend(CONVERSATION_MULTITURN["messages"])
+        self.assertEqual(
+            pickle.loads(pickle.dumps(render_conversation))(CONVERSATION_MULTITURN, conversation_template),
+            {"text": conversation_template.render(messages)},
+        )
+
+    def test_batch_render(self):
+        conversations = [CONVERSATION_SINGLETURN["messages"], CONVERSATION_MULTITURN["messages"]]
+        for conversation_template in [
+            self.conversation_template,
+            PRESET_TEMPLATES["qwen2_5"],
+            PRESET_TEMPLATES["qwen3"],
+        ]:
+            self.assertEqual(
+                conversation_template.batch_render(conversations),
+                [conversation_template.render(messages) for messages in conversations],
+            )
+
+    def test_render_cache(self):
+        messages = CONVERSATION_MULTITURN["messages"]
+        self.addCleanup(_jinja_env.clear_render_cache)
+        with patch.object(_jinja_env, "_RENDER_CACHE_SIZE", 1):
+            rendered = self.conversation_template.render(messages)
+            self.assertEqual(self.conversation_template.render(messages), rendered)
+            self.assertEqual(len(_jinja_env._render_cache), 1)
+            # Different arguments are different cache entries.
+            self.assertNotEqual(self.conversation_template.render(messages, tools=[{"name": "a"}]), rendered)
+            self.assertEqual(len(_jinja_env._render_cache), 1)
+            # Unhashable values are rendered without the cache.
+            self.assertEqual(self.conversation_template.render(messages, unused={1}), rendered)
+
+    def test_tool_schemas(self):
+        tool = {"type": "function", "function": {"name": "get_weather"}}
+        self.assertIsNone(_get_tool_schemas(None))
+        self.assertEqual(_get_tool_schemas([tool]), [tool])
+        self.assertEqual(_get_tool_schemas([get_weather])[0]["function"]["name"], "get_weather")
+        with self.assertRaises(ValueError):
+            _get_tool_schemas(["get_weather"])
+
+
 if __name__ == "__main__":
     unittest.main()
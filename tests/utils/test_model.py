@@ -0,0 +1,126 @@
+import json
+import os
+import tempfile
+import unittest
+
+import torch
+from safetensors.torch import load_file, save_file
+from transformers import GPT2Config
+
+from lmflow.utils.model import merge_lora_weights_streaming
+
+
+class MergeLoraWeightsStreamingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.model_path = os.path.join(self.tmp_dir.name, "model")
+        self.lora_path = os.path.join(self.tmp_dir.name, "lora")
+        self.output_path = os.path.join(self.tmp_dir.name, "merged")
+        os.makedirs(self.model_path)
+        os.makedirs(self.lora_path)
+        torch.manual_seed(0)
+
+    def save_adapter(self, adapter_state_dict, **adapter_config):
+        save_file(adapter_state_dict, os.path.join(self.lora_path, "adapter_model.safetensors"))
+        with open(os.path.join(self.lora_path, "adapter_config.json"), "w") as f:
+            json.dump(adapter_config, f)
+
+    def test_merge_without_base_model_prefix(self):
+        # gpt2 checkpoints store `h.0...` while the adapter names `transformer.h.0...`, and its
+        # Conv1D weights are stored as (in_features, out_features), i.e. fan_in_fan_out.
+        GPT2Config(n_embd=4, n_layer=1, n_head=1).save_pretrained(self.model_path)
+        base_state_dict = {
+            "h.0.attn.c_attn.weight": torch.randn(4, 12),
+            "h.0.mlp.c_fc.weight": torch.randn(4, 16),
+            "wte.weight": torch.randn(8, 4),
+        }
+        save_file(base_state_dict, os.path.join(self.model_path, "model.safetensors"))
+        lora_a, lora_b = torch.randn(2, 4), torch.randn(12, 2)
+        self.save_adapter(
+            {
+                "base_model.model.transformer.h.0.attn.c_attn.lora_A.weight": lora_a,
+                "base_model.model.transformer.h.0.attn.c_attn.lora_B.weight": lora_b,
+            },
+            r=2,
+            lora_alpha=4,
+            use_rslora=True,
+            fan_in_fan_out=True,
+        )
+
+        merge_lora_weights_streaming(self.model_path, self.lora_path, self.output_path)
+
+        merged_state_dict = load_file(os.path.join(self.output_path, "model.safetensors"))
+        scale = 4 / 2**0.5
+        torch.testing.assert_close(
+            merged_state_dict["h.0.attn.c_attn.weight"],
+            base_state_dict["h.0.attn.c_attn.weight"] + scale * (lora_b @ lora_a).T,
+        )
+        torch.testing.assert_close(merged_state_dict["h.0.mlp.c_fc.weight"], base_state_dict["h.0.mlp.c_fc.weight"])
+        torch.testing.assert_close(merged_state_dict["wte.weight"], base_state_dict["wte.weight"])
+        self.assertTrue(os.path.exists(os.path.join(self.output_path, "config.json")))
+
+    def test_merge(self):
+        base_state_dict = {
+            "model.layers.0.self_attn.q_proj.weight": torch.randn(6, 4),
+            "lm_head.weight": torch.randn(8, 4),
+        }
+        save_file(base_state_dict, os.path.join(self.model_path, "model.safetensors"))
+        lora_a, lora_b = torch.randn(2, 4), torch.randn(6, 2)
+        lm_head = torch.randn(8, 4)
+        self.save_adapter(
+            {
+                "base_model.model.model.layers.0.self_attn.q_proj.lora_A.weight": lora_a,
+                "base_model.model.model.layers.0.self_attn.q_proj.lora_B.weight": lora_b,
+                "base_model.model.lm_head.modules_to_save.weight": lm_head,
+            },
+            r=2,
+            lora_alpha=8,
+        )
+
+        merge_lora_weights_streaming(self.model_path, self.lora_path, self.output_path)
+
+        merged_state_dict = load_file(os.path.join(self.output_path, "model.safetensors"))
+        torch.testing.assert_close(
+            merged_state_dict["model.layers.0.self_attn.q_proj.weight"],
+            base_state_dict["model.layers.0.self_attn.q_proj.weight"] + 4 * lora_b @ lora_a,
+        )
+        torch.testing.assert_close(merged_state_dict["lm_head.weight"], lm_head)
+
+    def test_merge_unmatched_adapter(self):
+        save_file({"model.embed_tokens.weight": torch.randn(8, 4)}, os.path.join(self.model_path, "model.safetensors"))
+        self.save_adapter(
+            {
+                "base_model.model.model.layers.0.self_attn.q_proj.lora_A.weight": torch.randn(2, 4),
+                "base_model.model.model.layers.0.self_attn.q_proj.lora_B.weight": torch.randn(6, 2),
+            },
+            r=2,
+            lora_alpha=8,
+        )
+
+        with self.assertRaises(ValueError):
+            merge_lora_weights_streaming(self.model_path, self.lora_path, self.output_path)
+        self.assertFalse(os.path.exists(self.output_path))
+
+    def test_merge_lora_bias(self):
+        save_file(
+            {"model.layers.0.self_attn.q_proj.weight": torch.randn(6, 4)},
+            os.path.join(self.model_path, "model.safetensors"),
+        )
+        self.save_adapter(
+            {
+                "base_model.model.model.layers.0.self_attn.q_proj.lora_A.weight": torch.randn(2, 4),
+                "base_model.model.model.layers.0.self_attn.q_proj.lora_B.weight": torch.randn(6, 2),
+                "base_model.model.model.layers.0.self_attn.q_proj.lora_B.bias": torch.randn(6),
+            },
+            r=2,
+            lora_alpha=8,
+        )
+
+        with self.assertRaises(NotImplementedError):
+            merge_lora_weights_streaming(self.model_path, self.lora_path, self.output_path)
+        self.assertFalse(os.path.exists(self.output_path))
+
+
+if __name__ == "__main__":
+    unittest.main()